@@ -7,75 +7,26 @@
 
 
 import numpy as np
-import random
-n = 40428967  #total number of records in the clickstream data 
 sample_size = 1000000
-skip_values = sorted(random.sample(range(1,n), n-sample_size)) 
-
-types_train = {
-    'id': np.dtype(int),
-    'click': np.dtype(int),
-    'hour': np.dtype(int),
-    'C1': np.dtype(int),
-    'banner_pos': np.dtype(int),
-    'site_id': np.dtype(str),
-    'site_domain': np.dtype(str), 
-    'site_category': np.dtype(str),
-    'app_id': np.dtype(str),
-    'app_domain': np.dtype(str),
-    'app_category': np.dtype(str),
-    'device_id': np.dtype(str),
-    'device_ip': np.dtype(str),
-    'device_model': np.dtype(str),
-    'device_type': np.dtype(int),
-    'device_conn_type': np.dtype(int),
-    'C14': np.dtype(int),
-    'C15': np.dtype(int),
-    'C16': np.dtype(int),
-    'C17': np.dtype(int),
-    'C18': np.dtype(int),
-    'C19': np.dtype(int),
-    'C20': np.dtype(int),
-    'C21':np.dtype(int)
-}
+sample_seed = 42  # reservoir sampling over a single pass of train.gz
 
-types_test = {
-    'id': np.dtype(int),
-    'hour': np.dtype(int),
-    'C1': np.dtype(int),
-    'banner_pos': np.dtype(int),
-    'site_id': np.dtype(str),
-    'site_domain': np.dtype(str), 
-    'site_category': np.dtype(str),
-    'app_id': np.dtype(str),
-    'app_domain': np.dtype(str),
-    'app_category': np.dtype(str),
-    'device_id': np.dtype(str),
-    'device_ip': np.dtype(str),
-    'device_model': np.dtype(str),
-    'device_type': np.dtype(int),
-    'device_conn_type': np.dtype(int),
-    'C14': np.dtype(int),
-    'C15': np.dtype(int),
-    'C16': np.dtype(int),
-    'C17': np.dtype(int),
-    'C18': np.dtype(int),
-    'C19': np.dtype(int),
-    'C20': np.dtype(int),
-    'C21':np.dtype(int)
-}
+from ctr.schema import types_train, types_test, compact_types, narrow_ints, memory_report
 
 
 # In[ ]:
 
 
+import functools
 import pandas as pd
-import gzip
-
-parse_date = lambda val : pd.datetime.strptime(val, '%y%m%d%H')
+from ctr.ingest import load_sample, load_train
+from ctr.cache import cached_frame
 
-with gzip.open('train.gz') as f:
-    train = pd.read_csv(f, parse_dates = ['hour'], date_parser = parse_date, dtype=types_train, skiprows = skip_values)
+# string columns are read as categoricals and integers narrowed to the smallest width;
+# decodes the YYMMDDHH hour column and adds hour_of_day and day_of_week;
+# the result is cached on disk and memory-mapped back on later runs
+# (`python -m ctr ingest` fills the same cache)
+build = functools.partial(load_train, 'train.gz', sample_size, sample_seed)
+train = cached_frame(build, 'train.gz', sample_size=sample_size, seed=sample_seed, compact=True)
 
 train.head()
 
@@ -92,6 +43,15 @@ train.shape
 train.dtypes
 
 
+# Memory used by the compact dtypes compared with reading every string column as Python objects, on a 100k row sample.
+
+# In[ ]:
+
+
+memory_report(objects=load_sample('train.gz', sample_size=100000, seed=sample_seed, dtype=types_train),
+              compact=narrow_ints(load_sample('train.gz', sample_size=100000, seed=sample_seed, dtype=compact_types(types_train))))
+
+
 # Target feature -> click
 # 
 # site features -> site_id, site_domain, site_category
@@ -148,12 +108,11 @@ plt.title('Number of clicks by hour');
 # 
 # #### Hour
 # 
-# Extract hour from date time feature.
+# Hour of day was extracted from the date time feature at load time.
 
 # In[ ]:
 
 
-train['hour_of_day'] = train.hour.apply(lambda x: x.hour)
 train.groupby('hour_of_day').agg({'click':'sum'}).plot(figsize=(12,6))
 plt.ylabel('Number of clicks')
 plt.title('click trends by hour of day');
@@ -194,11 +153,12 @@ train.head(3)
 
 import seaborn as sns
 
-df_click = train[train['click'] == 1]
-df_hour = train[['hour_of_day','click']].groupby(['hour_of_day']).count().reset_index()
-df_hour = df_hour.rename(columns={'click': 'impressions'})
-df_hour['clicks'] = df_click[['hour_of_day','click']].groupby(['hour_of_day']).count().reset_index()['click']
-df_hour['CTR'] = df_hour['clicks']/df_hour['impressions']*100
+from ctr.eda import ctr_tables
+
+# impressions, clicks and CTR for every feature explored below, in one pass each
+ctr_by = ctr_tables(train, ['hour_of_day', 'day_of_week', 'C1', 'banner_pos', 'site_id',
+                            'site_domain', 'site_category', 'device_type'])
+df_hour = ctr_by['hour_of_day']
 
 plt.figure(figsize=(12,6))
 sns.barplot(y='CTR', x='hour_of_day', data=df_hour)
@@ -212,7 +172,6 @@ plt.title('Hourly CTR');
 # In[ ]:
 
 
-train['day_of_week'] = train['hour'].apply(lambda val: val.weekday_name)
 cats = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 train.groupby('day_of_week').agg({'click':'sum'}).reindex(cats).plot(figsize=(12,6))
 ticks = list(range(0, 7, 1)) # points on the x axis where you want the label to appear
@@ -244,11 +203,7 @@ train.head(3)
 # In[ ]:
 
 
-df_click = train[train['click'] == 1]
-df_dayofweek = train[['day_of_week','click']].groupby(['day_of_week']).count().reset_index()
-df_dayofweek = df_dayofweek.rename(columns={'click': 'impressions'})
-df_dayofweek['clicks'] = df_click[['day_of_week','click']].groupby(['day_of_week']).count().reset_index()['click']
-df_dayofweek['CTR'] = df_dayofweek['clicks']/df_dayofweek['impressions']*100
+df_dayofweek = ctr_by['day_of_week']
 
 plt.figure(figsize=(12,6))
 sns.barplot(y='CTR', x='day_of_week', data=df_dayofweek, order=['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'])
@@ -278,13 +233,8 @@ print(train.C1.value_counts()/len(train))
 # In[ ]:
 
 
-C1_values = train.C1.unique()
-C1_values.sort()
-ctr_avg_list=[]
-for i in C1_values:
-    ctr_avg=train.loc[np.where((train.C1 == i))].click.mean()
-    ctr_avg_list.append(ctr_avg)
-    print("for C1 value: {},  click through rate: {}".format(i,ctr_avg))
+for row in ctr_by['C1'].itertuples():
+    print("for C1 value: {},  click through rate: {}".format(row.C1, row.CTR/100))
 
 
 # In[ ]:
@@ -296,10 +246,7 @@ train.groupby(['C1', 'click']).size().unstack().plot(kind='bar', figsize=(12,6),
 # In[ ]:
 
 
-df_c1 = train[['C1','click']].groupby(['C1']).count().reset_index()
-df_c1 = df_c1.rename(columns={'click': 'impressions'})
-df_c1['clicks'] = df_click[['C1','click']].groupby(['C1']).count().reset_index()['click']
-df_c1['CTR'] = df_c1['clicks']/df_c1['impressions']*100
+df_c1 = ctr_by['C1']
 
 plt.figure(figsize=(12,6))
 sns.barplot(y='CTR', x='C1', data=df_c1)
@@ -343,13 +290,8 @@ print(train.banner_pos.value_counts()/len(train))
 # In[ ]:
 
 
-banner_pos = train.banner_pos.unique()
-banner_pos.sort()
-ctr_avg_list=[]
-for i in banner_pos:
-    ctr_avg=train.loc[np.where((train.banner_pos == i))].click.mean()
-    ctr_avg_list.append(ctr_avg)
-    print("for banner position: {},  click through rate: {}".format(i,ctr_avg))
+for row in ctr_by['banner_pos'].itertuples():
+    print("for banner position: {},  click through rate: {}".format(row.banner_pos, row.CTR/100))
 
 
 # The important banner positions are:
@@ -367,10 +309,7 @@ train.groupby(['banner_pos', 'click']).size().unstack().plot(kind='bar', figsize
 # In[ ]:
 
 
-df_banner = train[['banner_pos','click']].groupby(['banner_pos']).count().reset_index()
-df_banner = df_banner.rename(columns={'click': 'impressions'})
-df_banner['clicks'] = df_click[['banner_pos','click']].groupby(['banner_pos']).count().reset_index()['click']
-df_banner['CTR'] = df_banner['clicks']/df_banner['impressions']*100
+df_banner = ctr_by['banner_pos']
 sort_banners = df_banner.sort_values(by='CTR',ascending=False)['banner_pos'].tolist()
 plt.figure(figsize=(12,6))
 sns.barplot(y='CTR', x='banner_pos', data=df_banner, order=sort_banners)
@@ -398,37 +337,33 @@ print("There are {} sites in the data set".format(train.site_id.nunique()))
 # In[ ]:
 
 
+from ctr.eda import top_k_ctr
+
+# frequency share and CTR of the 10 most frequent values, one pass per column
+top10_ctr = top_k_ctr(train, ['site_id', 'site_domain', 'site_category', 'device_id'], k=10)
+
 print('The top 10 site ids that have the most impressions')
-print((train.site_id.value_counts()/len(train))[0:10])
+print(top10_ctr['site_id'].set_index('site_id').share)
 
 
 # In[ ]:
 
 
-top10_ids = (train.site_id.value_counts()/len(train))[0:10].index
-click_avg_list=[]
-
-for i in top10_ids:
-    click_avg=train.loc[np.where((train.site_id == i))].click.mean()
-    click_avg_list.append(click_avg)
-    print("for site id value: {},  click through rate: {}".format(i,click_avg))
+for row in top10_ctr['site_id'].itertuples():
+    print("for site id value: {},  click through rate: {}".format(row.site_id, row.CTR/100))
 
 
 # In[ ]:
 
 
-top10_sites = train[(train.site_id.isin((train.site_id.value_counts()/len(train))[0:10].index))]
-top10_sites_click = top10_sites[top10_sites['click'] == 1]
+top10_sites = train[train.site_id.isin(top10_ctr['site_id'].site_id)]
 top10_sites.groupby(['site_id', 'click']).size().unstack().plot(kind='bar', figsize=(12,6), title='Top 10 site ids histogram');
 
 
 # In[ ]:
 
 
-df_site = top10_sites[['site_id','click']].groupby(['site_id']).count().reset_index()
-df_site = df_site.rename(columns={'click': 'impressions'})
-df_site['clicks'] = top10_sites_click[['site_id','click']].groupby(['site_id']).count().reset_index()['click']
-df_site['CTR'] = df_site['clicks']/df_site['impressions']*100
+df_site = ctr_by['site_id'].nlargest(10, 'impressions')
 sort_site = df_site.sort_values(by='CTR',ascending=False)['site_id'].tolist()
 plt.figure(figsize=(12,6))
 sns.barplot(y='CTR', x='site_id', data=df_site, order=sort_site)
@@ -449,36 +384,27 @@ print("There are {} site domains in the data set".format(train.site_domain.nuniq
 
 
 print('The top 10 site domains that have the most impressions')
-print((train.site_domain.value_counts()/len(train))[0:10])
+print(top10_ctr['site_domain'].set_index('site_domain').share)
 
 
 # In[ ]:
 
 
-top10_domains = (train.site_domain.value_counts()/len(train))[0:10].index
-click_avg_list=[]
-
-for i in top10_domains:
-    click_avg=train.loc[np.where((train.site_domain == i))].click.mean()
-    click_avg_list.append(click_avg)
-    print("for site domain value: {},  click through rate: {}".format(i,click_avg))
+for row in top10_ctr['site_domain'].itertuples():
+    print("for site domain value: {},  click through rate: {}".format(row.site_domain, row.CTR/100))
 
 
 # In[ ]:
 
 
-top10_domain = train[(train.site_domain.isin((train.site_domain.value_counts()/len(train))[0:10].index))]
-top10_domain_click = top10_domain[top10_domain['click'] == 1]
+top10_domain = train[train.site_domain.isin(top10_ctr['site_domain'].site_domain)]
 top10_domain.groupby(['site_domain', 'click']).size().unstack().plot(kind='bar', figsize=(12,6), title='Top 10 site domains histogram');
 
 
 # In[ ]:
 
 
-df_domain = top10_domain[['site_domain','click']].groupby(['site_domain']).count().reset_index()
-df_domain = df_domain.rename(columns={'click': 'impressions'})
-df_domain['clicks'] = top10_domain_click[['site_domain','click']].groupby(['site_domain']).count().reset_index()['click']
-df_domain['CTR'] = df_domain['clicks']/df_domain['impressions']*100
+df_domain = ctr_by['site_domain'].nlargest(10, 'impressions')
 sort_domain = df_domain.sort_values(by='CTR',ascending=False)['site_domain'].tolist()
 plt.figure(figsize=(12,6))
 sns.barplot(y='CTR', x='site_domain', data=df_domain, order=sort_domain)
@@ -499,36 +425,27 @@ print("There are {} site categories in the data set".format(train.site_category.
 
 
 print('The top 10 site categories that have the most impressions')
-print((train.site_category.value_counts()/len(train))[0:10])
+print(top10_ctr['site_category'].set_index('site_category').share)
 
 
 # In[ ]:
 
 
-top10_categories = (train.site_category.value_counts()/len(train))[0:10].index
-click_avg_list=[]
-
-for i in top10_categories:
-    click_avg=train.loc[np.where((train.site_category == i))].click.mean()
-    click_avg_list.append(click_avg)
-    print("for site category value: {},  click through rate: {}".format(i,click_avg))
+for row in top10_ctr['site_category'].itertuples():
+    print("for site category value: {},  click through rate: {}".format(row.site_category, row.CTR/100))
 
 
 # In[ ]:
 
 
-top10_category = train[(train.site_category.isin((train.site_category.value_counts()/len(train))[0:10].index))]
-top10_category_click = top10_category[top10_category['click'] == 1]
+top10_category = train[train.site_category.isin(top10_ctr['site_category'].site_category)]
 top10_category.groupby(['site_category', 'click']).size().unstack().plot(kind='bar', figsize=(12,6), title='Top 10 site categories histogram');
 
 
 # In[ ]:
 
 
-df_category = top10_category[['site_category','click']].groupby(['site_category']).count().reset_index()
-df_category = df_category.rename(columns={'click': 'impressions'})
-df_category['clicks'] = top10_category_click[['site_category','click']].groupby(['site_category']).count().reset_index()['click']
-df_category['CTR'] = df_category['clicks']/df_category['impressions']*100
+df_category = ctr_by['site_category'].nlargest(10, 'impressions')
 sort_category = df_category.sort_values(by='CTR',ascending=False)['site_category'].tolist()
 plt.figure(figsize=(12,6))
 sns.barplot(y='CTR', x='site_category', data=df_category, order=sort_category)
@@ -549,26 +466,20 @@ print("There are {} devices in the data set".format(train.device_id.nunique()))
 
 
 print('The top 10 devices that have the most impressions')
-print((train.device_id.value_counts()/len(train))[0:10])
+print(top10_ctr['device_id'].set_index('device_id').share)
 
 
 # In[ ]:
 
 
-top10_devices = (train.device_id.value_counts()/len(train))[0:10].index
-click_avg_list=[]
-
-for i in top10_devices:
-    click_avg=train.loc[np.where((train.device_id == i))].click.mean()
-    click_avg_list.append(click_avg)
-    print("for device id value: {},  click through rate: {}".format(i,click_avg))
+for row in top10_ctr['device_id'].itertuples():
+    print("for device id value: {},  click through rate: {}".format(row.device_id, row.CTR/100))
 
 
 # In[ ]:
 
 
-top10_device = train[(train.device_id.isin((train.device_id.value_counts()/len(train))[0:10].index))]
-top10_device_click = top10_device[top10_device['click'] == 1]
+top10_device = train[train.device_id.isin(top10_ctr['device_id'].device_id)]
 top10_device.groupby(['device_id', 'click']).size().unstack().plot(kind='bar', figsize=(12,6), title='Top 10 device ids histogram');
 
 
@@ -587,6 +498,21 @@ print("There are {} device models in the data set".format(train.device_model.nun
 print("There are {} device cnn types in the data set".format(train.device_conn_type.nunique()))
 
 
+# The counts above only cover the sample. Approximate distinct counts (HyperLogLog) and top 10 values with CTR (Count-Min) over all 40M rows take one streaming pass with fixed memory.
+
+# In[ ]:
+
+
+from ctr.ingest import iter_batches
+from ctr.sketch import sketch_batches
+
+full_sketches = sketch_batches(iter_batches('train.gz', dtype=compact_types(types_train), batch_size=500000),
+                               ['device_ip', 'device_id', 'site_id'], k=10)
+for field, (distinct, heavy) in full_sketches.items():
+    print("There are about {} {} values in the full data set".format(distinct.count(), field))
+full_sketches['site_id'][1].top('site_id')
+
+
 # #### device type
 
 # In[ ]:
@@ -607,7 +533,7 @@ train[['device_type','click']].groupby(['device_type','click']).size().unstack()
 # In[ ]:
 
 
-df_click[df_click['device_type']==1].groupby(['hour_of_day', 'click']).size().unstack().plot(kind='bar', title="Clicks from device type 1 by hour of day", figsize=(12,6));
+train[(train['click'] == 1) & (train['device_type'] == 1)].groupby(['hour_of_day', 'click']).size().unstack().plot(kind='bar', title="Clicks from device type 1 by hour of day", figsize=(12,6));
 
 
 # As expected, most clicks happened during the business hours from device type 1. device type is definitely an important feature. 
@@ -615,15 +541,7 @@ df_click[df_click['device_type']==1].groupby(['hour_of_day', 'click']).size().un
 # In[ ]:
 
 
-device_type_click = df_click.groupby('device_type').agg({'click':'sum'}).reset_index()
-device_type_impression = train.groupby('device_type').agg({'click':'count'}).reset_index().rename(columns={'click': 'impressions'})
-merged_device_type = pd.merge(left = device_type_click , right = device_type_impression, how = 'inner', on = 'device_type')
-
-
-# In[ ]:
-
-
-merged_device_type['CTR'] = merged_device_type['click'] / merged_device_type['impressions']*100
+merged_device_type = ctr_by['device_type']
 
 
 # In[ ]:
@@ -704,20 +622,40 @@ train.groupby(['C18', 'click']).size().unstack().plot(kind='bar', stacked=True,
 train.head(3)
 
 
+# High-cardinality ids such as device_ip are mostly seen a handful of times, so their hashed value says little on its own. Their impression counts and smoothed click rates are added as features; each row is encoded only from rows of earlier hours, so its own label does not leak into its features.
+
 # In[ ]:
 
 
-def convert_obj_to_int(self):
-    
-    object_list_columns = self.columns
-    object_list_dtypes = self.dtypes
-    new_col_suffix = '_int'
-    for index in range(0,len(object_list_columns)):
-        if object_list_dtypes[index] == object :
-            self[object_list_columns[index]+new_col_suffix] = self[object_list_columns[index]].map( lambda  x: hash(x))
-            self.drop([object_list_columns[index]],inplace=True,axis=1)
-    return self
-train = convert_obj_to_int(train)
+from ctr.target_encoding import TargetEncoder
+
+encoder = TargetEncoder()
+train = encoder.fit_transform(train, hours=train.hour.values)
+# the tables built from the whole sample encode the test rows
+encoder.save('encoder')
+
+
+# In[ ]:
+
+
+from ctr.hashing import FeatureHasher
+from ctr.features import convert_obj_to_int
+
+# seeded, process-independent hashing; keep `hasher` to encode the test data the same way
+hasher = FeatureHasher(n_buckets=2**24, seed=0)
+train = convert_obj_to_int(train, hasher)
+
+
+# The plots above show click rates that depend on combinations of columns, e.g. device type by hour of day, which the trees only see one column at a time. Each cross hashes a pair or triple of codes into one categorical feature; the time and memory of every cross are recorded as a stage.
+
+# In[ ]:
+
+
+from ctr.crosses import CROSSES, add_crosses, cross_name
+from ctr.instrument import recorder
+
+train = add_crosses(train, hasher, CROSSES)
+pd.DataFrame([recorder.last['cross:' + cross_name(c)] for c in CROSSES]).set_index('stage')
 
 
 # In[ ]:
@@ -729,6 +667,11 @@ train.head(3)
 # In[ ]:
 
 
+from ctr.split import time_split
+
+# validate on the last two days and train on the earlier ones, like the model is served;
+# the rows are in time order, so both parts are slices (views) of the same rows
+train_rows, valid_rows = time_split(train.hour, valid_days=2)
 train.drop('hour', axis=1, inplace=True)
 
 
@@ -742,12 +685,12 @@ train.drop('id', axis=1, inplace=True)
 
 
 import lightgbm as lgb
-X_train = train.loc[:, train.columns != 'click']
+from ctr.matrix import FeatureMatrix
+# one float32 matrix feeds both the LightGBM and the XGBoost datasets below
+fm = FeatureMatrix.from_frame(train, [c for c in train.columns if c != 'click'])
 y_target = train.click.values
 #create lightgbm dataset
-msk = np.random.rand(len(X_train)) < 0.8
-lgb_train = lgb.Dataset(X_train[msk], y_target[msk])
-lgb_eval = lgb.Dataset(X_train[~msk], y_target[~msk], reference=lgb_train)
+lgb_train, lgb_eval = fm.lgb_datasets(y_target, train_rows, valid_rows)
 
 
 # In[ ]:
@@ -758,7 +701,7 @@ params = {
     'task': 'train',
     'boosting_type': 'gbdt',
     'objective': 'binary',
-    'metric': { 'binary_logloss'},
+    'metric': 'binary_logloss',
     'num_leaves': 31, # defauly leaves(31) amount for each tree
     'learning_rate': 0.08,
     'feature_fraction': 0.7, # will select 70% features before training each tree
@@ -767,13 +710,14 @@ params = {
     'verbose': 0
 }
 
+from ctr.train import train_lightgbm
+
 print('Start training...')
 # train
-gbm = lgb.train(params,
-                lgb_train,
-                num_boost_round=4000,
-                valid_sets=lgb_eval,
-                early_stopping_rounds=500)
+gbm = train_lightgbm(params, lgb_train, lgb_eval,
+                     num_boost_round=4000,
+                     early_stopping_rounds=500)
+print('Trained in {seconds:.0f}s ({cpu_seconds:.0f}s CPU), peak RSS {peak_rss_mb:.0f} MB'.format(**recorder.last['train']))
 
 
 # In[ ]:
@@ -783,42 +727,61 @@ print(gbm.best_score)
 print(gbm.best_iteration)
 
 
+# The parameters above were picked by hand. `search` tries random configurations around them in parallel, stopping the weakest trials early, and writes the best one and every learning curve to `search/lightgbm`.
+
+# In[ ]:
+
+
+from ctr.search import search
+
+best = search(fm, y_target, train_rows, valid_rows, engine='lightgbm',
+              base_params=params, out_dir='search/lightgbm')
+print(best['params'], best['best_iteration'], best['logloss'])
+
+
+# The same model can be trained on all 40M rows without holding them in memory: train.gz is streamed, encoded and binned chunk by chunk into a LightGBM binary dataset that is cached under .ctr_cache and reused by later runs.
+
 # In[ ]:
 
 
-from operator import itemgetter
-from sklearn.model_selection import train_test_split
-import xgboost as xgb
-from sklearn.metrics import roc_auc_score
+from ctr.train import build_binary_dataset, train_lightgbm
 
-def run_default_test(train, test, features, target, random_state=0):
-    eta = 0.1
-    max_depth = 5
-    subsample = 0.8
-    colsample_bytree = 0.8
-    print('XGBoost params. ETA: {}, MAX_DEPTH: {}, SUBSAMPLE: {}, COLSAMPLE_BY_TREE: {}'.format(eta, max_depth, subsample, colsample_bytree))
-    params = {
-        "objective": "binary:logistic",
-        "booster" : "gbtree",
-        "eval_metric": "logloss",
-        "eta": eta,
-        "max_depth": max_depth,
-        "subsample": subsample,
-        "colsample_bytree": colsample_bytree,
-        "silent": 1,
-        "seed": random_state
-    }
-    num_boost_round = 260
-    early_stopping_rounds = 20
-    test_size = 0.2
+# the crosses are rebuilt batch by batch; the target encoding is not, since its tables were
+# fitted on the sample rows, so gbm_full lacks those features and is scored without the encoder
+full_train = build_binary_dataset('train.gz', hasher, params=params, crosses=CROSSES)
+gbm_full = train_lightgbm(params, full_train, num_boost_round=gbm.best_iteration)
 
-    X_train, X_valid = train_test_split(train, test_size=test_size, random_state=random_state)
-    y_train = X_train[target]
-    y_valid = X_valid[target]
-    dtrain = xgb.DMatrix(X_train[features], y_train)
-    dvalid = xgb.DMatrix(X_valid[features], y_valid)
-    watchlist = [(dtrain, 'train'), (dvalid, 'eval')]
-    gbm = xgb.train(params, dtrain, num_boost_round, evals=watchlist, early_stopping_rounds=early_stopping_rounds, verbose_eval=True)
+
+# Score the test set with the trained model. The test file is streamed in chunks and encoded with the same `hasher` as the training data.
+
+# In[ ]:
+
+
+import json
+from ctr.predict import predict_file
+
+# gbm.txt and hasher.json are also what `python -m ctr.serve` loads for online scoring
+gbm.save_model('gbm.txt')
+with open('hasher.json', 'w') as f:
+    json.dump(hasher.to_dict(), f)
+predict_file('gbm.txt', hasher, 'test.gz', 'submission.csv', encoder='encoder')
+
+
+# `gbm.ctrb` packs the model, the hash seeds, the encoder tables, the params and the feature list into one file. Loading maps it into memory instead of reading it, so `python -m ctr predict --model gbm.ctrb` and `python -m ctr serve --model gbm.ctrb` start at once and their workers share one copy of the tables.
+
+# In[ ]:
+
+
+from ctr.bundle import ModelBundle
+
+ModelBundle.from_booster(gbm, hasher, encoder, params,
+                         {'features': fm.features, 'rows': len(fm)}).save('gbm.ctrb')
+
+
+# In[ ]:
+
+
+from ctr.train import XGB_PARAMS, run_default_test
 
 
 # In[ ]:
@@ -828,8 +791,32 @@ features = ['C1', 'banner_pos', 'device_type', 'device_conn_type', 'C14',
        'C15', 'C16', 'C17', 'C18', 'C19', 'C20', 'C21', 'hour_of_day',
        'site_id_int', 'site_domain_int', 'site_category_int', 'app_id_int',
        'app_domain_int', 'app_category_int', 'device_id_int', 'device_ip_int',
-       'device_model_int', 'day_of_week_int']
-run_default_test(train, y_target, features, 'click')
+       'device_model_int', 'day_of_week_int'] + encoder.output_columns()
+features += [cross_name(c) for c in CROSSES]
+# in the matrix's column order, so that fm.columns(features) is fm itself and not a copy
+features = [name for name in fm.features if name in features]
+xgb_gbm = run_default_test(fm, (train_rows, valid_rows), features, y_target)
+ModelBundle.from_booster(xgb_gbm, hasher, encoder, XGB_PARAMS,
+                         {'features': features}).save('xgb.ctrb')
+
+
+# In[ ]:
+
+
+xgb_best = search(fm.columns(features), y_target, train_rows, valid_rows,
+                  engine='xgboost', max_rounds=243, out_dir='search/xgboost')
+run_default_test(fm, (train_rows, valid_rows), features, y_target, params=xgb_best['params'])
+
+
+# Time, rows and memory of every stage run above (load, encode, aggregate, train, predict). `metrics.prom` can be picked up by the Prometheus node exporter's textfile collector.
+
+# In[ ]:
+
+
+from ctr.instrument import recorder, export
+
+export('metrics.prom')
+pd.DataFrame(recorder.report()).T
 
 
 # In[ ]:
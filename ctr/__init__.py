@@ -0,0 +1 @@
+"""Click-through rate prediction on the Avazu clickstream data."""
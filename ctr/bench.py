@@ -0,0 +1,262 @@
+"""Benchmarks of the pipeline stages on synthetic clickstream data.
+
+    python -m ctr.bench --rows 100000 1000000 --out bench.json
+    python -m ctr.bench --rows 100000 1000000 --baseline bench.json
+
+Generates ``train.gz``-shaped files with the ``types_train`` columns and
+cardinalities close to the Avazu data, then times the notebook's load,
+``convert_obj_to_int``, CTR tables, ``lgb.train``, ``xgb.train`` and
+prediction on them.  Each stage records wall and CPU seconds, rows per
+second and peak RSS.  With ``--baseline`` the run is compared stage by
+stage against an earlier results file and the exit status is non-zero if
+any stage got slower than the tolerance allows.
+"""
+
+import argparse
+import contextlib
+import functools
+import gzip
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from ctr.cache import CACHE_DIR
+from ctr.eda import ctr_tables, top_k_ctr
+from ctr.features import add_time_features, convert_obj_to_int
+from ctr.hashing import FeatureHasher
+from ctr.matrix import FeatureMatrix
+from ctr.instrument import stage
+from ctr.schema import compact_types, narrow_ints, types_train
+from ctr.train import LGB_PARAMS, XGB_PARAMS
+
+# (number of distinct values in the full data, share of the most common
+# value, skew of the rest towards the first values of the vocabulary)
+STRING_COLUMNS = {
+    'site_id': (4737, 0.36, 3.0),
+    'site_domain': (7745, 0.37, 3.0),
+    'site_category': (26, 0.41, 2.0),
+    'app_id': (8552, 0.64, 3.0),
+    'app_domain': (559, 0.67, 3.0),
+    'app_category': (36, 0.65, 2.0),
+    'device_id': (2686408, 0.83, 1.5),
+    'device_ip': (6729486, 0.01, 1.5),
+    'device_model': (8251, 0.06, 3.0),
+}
+INT_COLUMNS = {
+    'C1': [1005, 1002, 1010, 1012, 1007, 1001, 1008],
+    'banner_pos': [0, 1, 7, 2, 4, 5, 3],
+    'device_type': [1, 0, 4, 5, 2],
+    'device_conn_type': [0, 2, 3, 5],
+    'C14': np.arange(375, 375 + 2626 * 9, 9),
+    'C15': [320, 300, 216, 728, 120, 1024, 480, 768],
+    'C16': [50, 250, 36, 480, 90, 20, 768, 320, 1024],
+    'C17': np.arange(112, 112 + 435 * 6, 6),
+    'C18': [0, 3, 2, 1],
+    'C19': np.arange(33, 33 + 68 * 28, 28),
+    'C20': np.r_[-1, np.arange(100000, 100000 + 171 * 1.45, 1.45).astype(int)],
+    'C21': np.arange(1, 256, 4),
+}
+FIRST_HOUR = np.datetime64('2014-10-21T00', 'h')
+HOURS = 240
+CTR_COLUMNS = ['hour_of_day', 'day_of_week', 'C1', 'banner_pos', 'site_id',
+               'site_domain', 'site_category', 'device_type']
+
+
+def _skewed(rng, n, size, top, skew):
+    """Indexes into a vocabulary of ``size``: 0 with probability ``top``,
+    the rest drawn with more weight on low indexes the larger ``skew``."""
+    idx = 1 + (rng.random_sample(n) ** skew * (size - 1)).astype(np.int64)
+    idx[rng.random_sample(n) < top] = 0
+    return idx
+
+
+@functools.lru_cache(maxsize=len(STRING_COLUMNS))
+def _vocabulary(name, size):
+    """Hex ids of column ``name`` and their click effects, the same for every chunk."""
+    rng = np.random.RandomState(list(types_train).index(name))
+    ids = pd.Series(rng.randint(0, 2 ** 32, size, dtype=np.uint64)).map('{:08x}'.format)
+    return ids.values, rng.normal(0, 0.5, size)
+
+
+def synthetic_frame(rows, seed=0, hours=None, total_rows=None):
+    """``rows`` of synthetic training data with the ``types_train`` columns.
+
+    Vocabularies are capped at ``total_rows`` (default ``rows``) values so
+    small files keep a realistic share of distinct ids.  Clicks follow a logistic model of
+    site, app, banner position and hour of day, with an average CTR near
+    the real 17%.
+    """
+    rng = np.random.RandomState(seed)
+    if hours is None:
+        hours = np.sort(rng.randint(0, HOURS, rows))
+    stamps = FIRST_HOUR + hours.astype('timedelta64[h]')
+    data = {'id': rng.randint(0, 2 ** 63, rows, dtype=np.uint64),
+            'click': None,
+            'hour': pd.DatetimeIndex(stamps).strftime('%y%m%d%H').astype(np.int64)}
+    logit = -1.55 + 0.3 * np.sin(2 * np.pi * (hours % 24) / 24)
+    for name in types_train:
+        if name in INT_COLUMNS:
+            values = np.asarray(INT_COLUMNS[name])
+            data[name] = values[_skewed(rng, rows, len(values), 0.5, 2.0)]
+        elif name in STRING_COLUMNS:
+            size, top, skew = STRING_COLUMNS[name]
+            size = max(2, min(size, total_rows or rows))
+            idx = _skewed(rng, rows, size, top, skew)
+            ids, effects = _vocabulary(name, size)
+            data[name] = ids[idx]
+            if name in ('site_id', 'app_id'):
+                logit += effects[idx]
+    logit += np.where(data['banner_pos'] == 0, 0.0, 0.2)
+    data['click'] = (rng.random_sample(rows) < 1 / (1 + np.exp(-logit))).astype(np.int8)
+    return pd.DataFrame(data, columns=list(types_train))
+
+
+def write_synthetic(path, rows, seed=0, chunk_size=1000000):
+    """Write ``rows`` of synthetic data to a gzipped csv like ``train.gz``.
+
+    Rows are generated ``chunk_size`` at a time in hour order, so files of
+    any size can be written in bounded memory.
+    """
+    rng = np.random.RandomState(seed)
+    hours = np.sort(rng.randint(0, HOURS, rows))
+    tmp = path + '.tmp'
+    with gzip.open(tmp, 'wt', compresslevel=1) as f:
+        for start in range(0, rows, chunk_size):
+            chunk = synthetic_frame(min(chunk_size, rows - start), seed + 1 + start,
+                                    hours[start:start + chunk_size], rows)
+            chunk.to_csv(f, header=start == 0, index=False)
+    os.replace(tmp, path)
+    return path
+
+
+def synthetic_file(rows, seed=0, data_dir=os.path.join(CACHE_DIR, 'bench')):
+    """Path of the synthetic file of ``rows`` rows, generated on first use."""
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    path = os.path.join(data_dir, 'train-%d-%d.gz' % (rows, seed))
+    if not os.path.exists(path):
+        write_synthetic(path, rows, seed)
+    return path
+
+
+@contextlib.contextmanager
+def _stage(results, name, rows=None):
+    with stage(name, rows) as record:
+        yield record
+    result = results[name] = {key: record[key] for key in (
+        'rows', 'seconds', 'cpu_seconds', 'peak_rss_mb', 'rss_delta_mb')}
+    result['rows_per_second'] = result['rows'] / result['seconds']
+    print('%-20s %9.2fs %12.0f rows/s %8.0f MB' % (
+        name, result['seconds'], result['rows_per_second'],
+        result['peak_rss_mb']), file=sys.stderr)
+
+
+def run(path, rounds=50, threads=None):
+    """Time every stage of the pipeline on ``path`` and return the results."""
+    import lightgbm as lgb
+    import xgboost as xgb
+
+    stages = {}
+    with _stage(stages, 'read_csv') as stage:
+        train = add_time_features(narrow_ints(
+            pd.read_csv(path, dtype=compact_types(types_train))))
+        rows = stage['rows'] = len(train)
+
+    with _stage(stages, 'ctr_groupby', rows):
+        ctr_tables(train, CTR_COLUMNS)
+        top_k_ctr(train, ['site_id', 'site_domain', 'site_category', 'device_id'])
+    with _stage(stages, 'convert_obj_to_int', rows):
+        train = convert_obj_to_int(train, FeatureHasher())
+    with _stage(stages, 'feature_matrix', rows):
+        fm = FeatureMatrix.from_frame(
+            train, [c for c in train.columns if c not in ('click', 'hour', 'id')])
+    label = train.click.values
+    del train
+
+    threads = threads or os.cpu_count() or 1
+    with _stage(stages, 'lgb_train', rows):
+        gbm = lgb.train(dict(LGB_PARAMS, num_threads=threads),
+                        lgb.Dataset(fm.data, label, feature_name=fm.features),
+                        num_boost_round=rounds)
+    with _stage(stages, 'xgb_train', rows):
+        dtrain = xgb.DMatrix(fm.data, label, feature_names=fm.features,
+                             nthread=threads)
+        xgb.train(dict(XGB_PARAMS, nthread=threads), dtrain, rounds)
+    with _stage(stages, 'predict', rows):
+        gbm.predict(fm.data, num_threads=threads)
+    return stages
+
+
+def environment():
+    import lightgbm as lgb
+    import xgboost as xgb
+
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__,
+            'pandas': pd.__version__, 'lightgbm': lgb.__version__,
+            'xgboost': xgb.__version__,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(baseline, current, tolerance=0.1, min_seconds=0.05):
+    """Stages of ``current`` more than ``tolerance`` slower than ``baseline``.
+
+    Both are results as written by ``main``; returns ``(rows, stage, old
+    seconds, new seconds)`` for every regression and prints every stage
+    present in both.  Slowdowns under ``min_seconds`` are taken as noise.
+    """
+    old = {r['rows']: r['stages'] for r in baseline['runs']}
+    regressions = []
+    for r in current['runs']:
+        for name, stage in r['stages'].items():
+            before = old.get(r['rows'], {}).get(name)
+            if before is None:
+                continue
+            ratio = stage['seconds'] / before['seconds']
+            flag = (ratio > 1 + tolerance
+                    and stage['seconds'] - before['seconds'] > min_seconds)
+            print('%10d %-20s %9.2fs -> %9.2fs %+7.1f%%%s' % (
+                r['rows'], name, before['seconds'], stage['seconds'],
+                100 * (ratio - 1), '  REGRESSION' if flag else ''))
+            if flag:
+                regressions.append((r['rows'], name, before['seconds'],
+                                    stage['seconds']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(CACHE_DIR, 'bench'))
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--baseline', default=None,
+                        help='earlier results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    results = {'environment': environment(), 'rounds': args.rounds, 'runs': []}
+    for rows in args.rows:
+        path = synthetic_file(rows, args.seed, args.data_dir)
+        print('%d rows' % rows, file=sys.stderr)
+        results['runs'].append({'rows': rows,
+                                'stages': run(path, args.rounds, args.threads)})
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.out is not None and args.out != args.baseline:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None and compare(baseline, results, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Single-file model bundles that load by memory-mapping.
+
+A bundle holds everything needed to score raw ``types_test`` rows: the
+flattened ``TreeEnsemble``, the native booster it came from, the
+``FeatureHasher`` seeds, the ``TargetEncoder`` tables if one was used, the
+input schema, the training params and free-form metadata.  The file is a
+short header followed by raw arrays::
+
+    magic (8 bytes) | format version (uint32) | header size (uint32)
+    JSON header | arrays, each starting at a multiple of 64 bytes
+
+The JSON header gives the dtype, shape and offset of every array.
+``ModelBundle.load`` maps the file once and takes each array as a view of
+the mapping, so loading reads only the header and a few pages however
+large the tables are, and worker processes scoring with the same bundle
+share its pages in the OS page cache instead of holding a copy each.
+"""
+
+import datetime
+import json
+import os
+import struct
+
+import numpy as np
+
+from ctr.features import ENCODER_VERSION
+from ctr.hashing import FeatureHasher
+from ctr.schema import types_test
+from ctr.train import json_params
+from ctr.trees import TreeEnsemble
+
+MAGIC = b'CTRBNDL\x00'
+FORMAT_VERSION = 1
+_ALIGN = 64
+_PREFIX = struct.Struct('<8sII')
+
+
+def is_bundle(path):
+    """Whether ``path`` is a bundle file, judged by its first bytes."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def _schema(types):
+    return [[name, np.dtype(dtype).kind] for name, dtype in types.items()]
+
+
+def _native(booster):
+    """``(kind, bytes)`` of a LightGBM or XGBoost booster's own model format."""
+    if hasattr(booster, 'model_to_string'):
+        return 'lightgbm', booster.model_to_string().encode('utf-8')
+    if hasattr(booster, 'save_raw'):
+        return 'xgboost', bytes(booster.save_raw('json'))
+    raise TypeError('not a LightGBM or XGBoost booster: %r' % type(booster))
+
+
+class ModelBundle(object):
+    """A scoring model with its feature pipeline state and training metadata.
+
+    ``model`` is a ``TreeEnsemble``; ``native`` optionally holds the
+    ``(kind, bytes)`` of the booster it was exported from, restored by
+    ``booster()``.
+    """
+
+    def __init__(self, model, hasher, encoder=None, params=None, metadata=None,
+                 native=None, schema=None):
+        self.model = model
+        self.hasher = hasher
+        self.encoder = encoder
+        # stored in the JSON header, so sets and NumPy values are converted
+        self.params = json_params(dict(params or {}))
+        self.metadata = json_params(dict(metadata or {}))
+        self.native = native
+        self.schema = schema if schema is not None else _schema(types_test)
+
+    @classmethod
+    def from_booster(cls, booster, hasher, encoder=None, params=None, metadata=None):
+        """Bundle a trained LightGBM or XGBoost booster."""
+        kind, data = _native(booster)
+        if kind == 'lightgbm':
+            model = TreeEnsemble.from_lightgbm(booster)
+        else:
+            model = TreeEnsemble.from_xgboost(booster)
+        metadata = dict(metadata or {})
+        if getattr(booster, 'best_iteration', None) is not None:
+            metadata.setdefault('best_iteration', int(booster.best_iteration))
+        return cls(model, hasher, encoder, params, metadata, native=(kind, data))
+
+    @property
+    def features(self):
+        return self.model.feature_names
+
+    def booster(self):
+        """The native booster, for inspection or further training."""
+        if self.native is None:
+            raise ValueError('the bundle holds no native booster')
+        kind, data = self.native
+        if kind == 'lightgbm':
+            import lightgbm as lgb
+
+            return lgb.Booster(model_str=bytes(data).decode('utf-8'))
+        import xgboost as xgb
+
+        booster = xgb.Booster()
+        booster.load_model(bytearray(data))
+        return booster
+
+    def check_schema(self, types=None):
+        """Raise ``ValueError`` if the bundle expects other input columns than ``types``."""
+        expected = _schema(types_test if types is None else types)
+        if self.schema != expected:
+            raise ValueError('bundle was trained on columns %s, not %s'
+                             % (self.schema, expected))
+
+    def save(self, path):
+        """Write the bundle to ``path``, replaced atomically."""
+        arrays, trees = self.model.to_arrays()
+        arrays = dict(('model/' + name, values) for name, values in arrays.items())
+        metadata = dict(self.metadata)
+        metadata.setdefault('created', datetime.datetime.now(datetime.timezone.utc).isoformat())
+        header = {'model': trees, 'hasher': self.hasher.to_dict(),
+                  'schema': self.schema, 'params': self.params,
+                  'metadata': metadata, 'encoder_version': ENCODER_VERSION}
+        if self.encoder is not None:
+            tables, header['encoder'] = self.encoder.to_arrays()
+            arrays.update(('encoder/' + key, values) for key, values in tables.items())
+        if self.native is not None:
+            header['native'] = self.native[0]
+            arrays['native'] = np.frombuffer(self.native[1], dtype=np.uint8)
+
+        # offsets are relative to the end of the header, so its size can be
+        # fixed after they are known
+        layout, offset = {}, 0
+        for name in sorted(arrays):
+            values = np.ascontiguousarray(arrays[name])
+            offset = -(-offset // _ALIGN) * _ALIGN
+            layout[name] = {'dtype': values.dtype.str, 'shape': list(values.shape),
+                            'offset': offset}
+            arrays[name] = values
+            offset += values.nbytes
+        header['arrays'] = layout
+        text = json.dumps(header).encode('utf-8')
+        start = -(-(_PREFIX.size + len(text)) // _ALIGN) * _ALIGN
+        text += b' ' * (start - _PREFIX.size - len(text))
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(text)))
+            f.write(text)
+            for name in sorted(arrays):
+                f.seek(start + layout[name]['offset'])
+                f.write(arrays[name].tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Open a bundle with every array memory-mapped read-only."""
+        with open(path, 'rb') as f:
+            magic, version, size = _PREFIX.unpack(f.read(_PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError('%s is not a model bundle' % path)
+            if version > FORMAT_VERSION:
+                raise ValueError('%s has bundle format %d; this version reads up to %d'
+                                 % (path, version, FORMAT_VERSION))
+            header = json.loads(f.read(size).decode('utf-8'))
+        if header['encoder_version'] != ENCODER_VERSION:
+            raise ValueError('%s was built with feature encoding version %d, not %d'
+                             % (path, header['encoder_version'], ENCODER_VERSION))
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        start = _PREFIX.size + size
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape'], dtype=np.int64))
+            lo = start + spec['offset']
+            arrays[name] = data[lo:lo + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+
+        def group(prefix):
+            return dict((name[len(prefix):], values) for name, values in arrays.items()
+                        if name.startswith(prefix))
+
+        model = TreeEnsemble.from_arrays(group('model/'), header['model'])
+        encoder = None
+        if 'encoder' in header:
+            from ctr.target_encoding import TargetEncoder
+
+            encoder = TargetEncoder.from_arrays(group('encoder/'), header['encoder'])
+        native = None
+        if 'native' in header:
+            native = (header['native'], arrays['native'])
+        return cls(model, FeatureHasher.from_dict(header['hasher']), encoder,
+                   header['params'], header['metadata'], native, header['schema'])
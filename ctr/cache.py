@@ -0,0 +1,103 @@
+"""Columnar on-disk cache of parsed and encoded frames.
+
+Each cached frame is a directory holding one ``.npy`` file per column and a
+``meta.json`` describing them.  Columns are loaded with ``np.load`` in
+memory-mapped mode and handed to pandas without copying, so a warm start
+only touches the pages that are actually used.  String columns are stored
+dictionary-encoded (integer codes plus the vocabulary) and come back as
+pandas categoricals.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from ctr.features import ENCODER_VERSION
+
+CACHE_DIR = '.ctr_cache'
+
+
+def file_digest(path, block_size=1 << 20):
+    """SHA-1 of the contents of ``path``."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_key(source, **params):
+    """Key identifying ``source`` read with ``params`` by the current encoder."""
+    payload = json.dumps({'source': file_digest(source),
+                          'encoder': ENCODER_VERSION,
+                          'params': params}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def save_frame(df, directory):
+    """Write ``df`` column by column into ``directory``."""
+    os.makedirs(directory)
+    columns = []
+    for i, (name, col) in enumerate(df.items()):
+        entry = {'name': name, 'file': '%d.npy' % i}
+        if isinstance(col.dtype, pd.CategoricalDtype) or not (
+                col.dtype.kind in 'biufcmM'):
+            cat = pd.Categorical(col)
+            entry['kind'] = 'category'
+            entry['categories'] = '%d.categories.npy' % i
+            np.save(os.path.join(directory, entry['categories']),
+                    np.asarray(cat.categories.astype(str), dtype=str))
+            np.save(os.path.join(directory, entry['file']), cat.codes)
+        else:
+            entry['kind'] = 'array'
+            np.save(os.path.join(directory, entry['file']),
+                    np.ascontiguousarray(col.values))
+        columns.append(entry)
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({'columns': columns, 'rows': len(df)}, f)
+
+
+def load_frame(directory, mmap_mode='c'):
+    """Load a frame written by ``save_frame`` with memory-mapped columns.
+
+    The default copy-on-write mapping lets callers modify the frame without
+    touching the files on disk.
+    """
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    data = {}
+    for entry in meta['columns']:
+        values = np.load(os.path.join(directory, entry['file']),
+                         mmap_mode=mmap_mode)
+        if entry['kind'] == 'category':
+            categories = np.load(os.path.join(directory, entry['categories']))
+            values = pd.Categorical.from_codes(values, categories.astype(object),
+                                               validate=False)
+        data[entry['name']] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def cached_frame(build, source, cache_dir=CACHE_DIR, **params):
+    """Return the frame produced by ``build()`` for ``source``, via the cache.
+
+    The cache entry is keyed by the contents of ``source``, ``params`` and
+    ``ENCODER_VERSION``.  When any of these change a new entry is built and
+    the stale entries for the same source are removed.
+    """
+    key = '%s-%s' % (os.path.basename(source), cache_key(source, **params))
+    directory = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(directory, 'meta.json')):
+        df = build()
+        tmp = os.path.join(cache_dir, '.tmp-%s' % uuid.uuid4().hex)
+        save_frame(df, tmp)
+        os.replace(tmp, directory)
+        prefix = os.path.basename(source) + '-'
+        for name in os.listdir(cache_dir):
+            if name.startswith(prefix) and name != key:
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+    return load_frame(directory)
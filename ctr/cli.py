@@ -0,0 +1,264 @@
+"""Command line entry points of the CTR pipeline.
+
+    python -m ctr ingest   --src train.gz --sample-size 1000000
+    python -m ctr features --src train.gz --sample-size 1000000 --out features
+    python -m ctr train    --features features --model gbm.txt
+    python -m ctr predict  --model gbm.npz --src test.gz --out submission.csv
+    python -m ctr serve    --model gbm.npz
+    python -m ctr ftrl     train --src train.gz --model ftrl.npz
+
+Each command imports only what it needs: pandas and NumPy for the data
+steps, LightGBM only for training, and nothing beyond NumPy, pandas and
+the tree walker when scoring with an ``.npz`` ensemble written by
+``train``.
+"""
+
+import argparse
+import functools
+import json
+import sys
+
+
+def _load_train(args):
+    from ctr.cache import cached_frame
+    from ctr.ingest import load_train
+
+    build = functools.partial(load_train, args.src, args.sample_size, args.seed)
+    return cached_frame(build, args.src, sample_size=args.sample_size,
+                        seed=args.seed, compact=True)
+
+
+def ingest(args):
+    """Sample the training file into the local cache."""
+    from ctr.schema import memory_report
+
+    train = _load_train(args)
+    print(memory_report(train=train))
+
+
+def features(args):
+    """Encode the sample into a feature matrix with labels and hours."""
+    import numpy as np
+
+    from ctr.features import convert_obj_to_int, hour_key
+    from ctr.hashing import FeatureHasher
+    from ctr.matrix import FeatureMatrix
+
+    train = _load_train(args)
+    if args.encoder:
+        from ctr.target_encoding import TargetEncoder
+
+        # each row is encoded from the hours before it, as when scoring
+        encoder = TargetEncoder(seed=args.hash_seed)
+        train = encoder.fit_transform(train, hours=hour_key(train['hour'].values))
+        encoder.save(args.encoder)
+    hasher = FeatureHasher(n_buckets=args.buckets, seed=args.hash_seed)
+    encoded = convert_obj_to_int(train, hasher)
+    if args.crosses:
+        from ctr.crosses import CROSSES, add_crosses
+
+        # scoring rebuilds the crosses from the model's feature names
+        encoded = add_crosses(encoded, hasher, CROSSES)
+    fm = FeatureMatrix.from_frame(
+        encoded, [c for c in encoded.columns if c not in ('click', 'hour', 'id')])
+    fm.save(args.out)
+    np.save(args.out + '.label.npy', np.asarray(encoded['click'].values, dtype=np.float32))
+    np.save(args.out + '.hour.npy', hour_key(train['hour'].values))
+    with open(args.hasher, 'w') as f:
+        json.dump(hasher.to_dict(), f)
+    print('%d rows, %d features -> %s.npy' % (len(fm), len(fm.features), args.out))
+
+
+def train(args):
+    """Train LightGBM on the feature matrix, stopping early on the last days."""
+    import numpy as np
+
+    from ctr.matrix import FeatureMatrix
+    from ctr.split import time_split
+    from ctr.target_encoding import encoded_in
+    from ctr.train import LGB_PARAMS, train_lightgbm
+    from ctr.trees import TreeEnsemble
+
+    params = dict(LGB_PARAMS)
+    if args.params:
+        with open(args.params) as f:
+            overrides = json.load(f)
+        # accept the best.json written by ctr.search as well as a bare dict
+        params.update(overrides.get('params', overrides))
+    fm = FeatureMatrix.load(args.features)
+    if args.bundle and encoded_in(fm.features) and not args.encoder:
+        # a bundle without the tables could not rebuild these features
+        raise SystemExit('--bundle needs --encoder with the tables of the features %s'
+                         % ', '.join(encoded_in(fm.features)))
+    if args.full:
+        # the tables were fitted on the sample, so encoding all of --src with
+        # them would give the sample rows features computed from their labels
+        if encoded_in(fm.features):
+            raise SystemExit('--full cannot rebuild the target encoding features %s; '
+                             'run features without --encoder to retrain on all rows'
+                             % ', '.join(encoded_in(fm.features)))
+    label = np.load(args.features + '.label.npy')
+    hours = np.load(args.features + '.hour.npy')
+    train_rows, valid_rows = time_split(hours, valid_days=args.valid_days)
+    train_set, valid_set = fm.lgb_datasets(label, train_rows, valid_rows, params=params)
+    booster = train_lightgbm(params, train_set, valid_set,
+                             num_boost_round=args.rounds,
+                             early_stopping_rounds=args.early_stopping_rounds)
+    best_score = booster.best_score['valid_0']
+    print('best iteration %d, %s' % (booster.best_iteration, dict(best_score)))
+    if args.full:
+        from ctr.crosses import crosses_in
+        from ctr.hashing import FeatureHasher
+        from ctr.train import build_binary_dataset
+
+        with open(args.hasher) as f:
+            hasher = FeatureHasher.from_dict(json.load(f))
+        full = build_binary_dataset(args.src, hasher, params=params,
+                                    crosses=crosses_in(fm.features))
+        sample_features = booster.feature_name()
+        booster = train_lightgbm(params, full, num_boost_round=booster.best_iteration)
+        if set(booster.feature_name()) != set(sample_features):
+            raise SystemExit('the full retrain has features %s, the sample model %s'
+                             % (booster.feature_name(), sample_features))
+    booster.save_model(args.model)
+    if args.compiled:
+        TreeEnsemble.from_lightgbm(booster).save(args.compiled)
+    if args.bundle:
+        from ctr.bundle import ModelBundle
+        from ctr.hashing import FeatureHasher
+
+        with open(args.hasher) as f:
+            hasher = FeatureHasher.from_dict(json.load(f))
+        encoder = None
+        if args.encoder:
+            from ctr.target_encoding import TargetEncoder
+
+            encoder = TargetEncoder.load(args.encoder)
+        metadata = {'features': args.features, 'rows': len(fm),
+                    'valid_days': args.valid_days, 'full': args.full,
+                    'best_iteration': booster.best_iteration or booster.current_iteration(),
+                    'best_score': dict(best_score)}
+        ModelBundle.from_booster(booster, hasher, encoder, params,
+                                 metadata).save(args.bundle)
+
+
+def predict(args):
+    """Score the test file in batches."""
+    from ctr.bundle import is_bundle
+    from ctr.hashing import FeatureHasher
+    from ctr.predict import predict_file
+
+    hasher = None
+    if not is_bundle(args.model):
+        with open(args.hasher) as f:
+            hasher = FeatureHasher.from_dict(json.load(f))
+    stats = predict_file(args.model, hasher, args.src, args.out,
+                         batch_size=args.batch_size, workers=args.workers,
+                         num_threads=args.threads, encoder=args.encoder)
+    print('%(rows)d rows in %(seconds).1fs (%(rows_per_second).0f rows/s)' % stats)
+
+
+def serve(args):
+    """Run the HTTP scoring service."""
+    from ctr import serve
+
+    serve.main(args.rest)
+
+
+def ftrl(args):
+    """Train or score the FTRL-Proximal logistic regression."""
+    from ctr import ftrl
+
+    ftrl.main(args.rest)
+
+
+def _data_args(parser):
+    parser.add_argument('--src', default='train.gz')
+    parser.add_argument('--sample-size', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=42)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m ctr',
+                                     description=__doc__.splitlines()[0])
+    parser.add_argument('--metrics', default=None,
+                        help='write stage timings here (.prom or .json)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('ingest', help=ingest.__doc__)
+    _data_args(p)
+    p.set_defaults(run=ingest)
+
+    p = commands.add_parser('features', help=features.__doc__)
+    _data_args(p)
+    p.add_argument('--out', default='features')
+    p.add_argument('--hasher', default='hasher.json')
+    p.add_argument('--buckets', type=int, default=2 ** 24)
+    p.add_argument('--hash-seed', type=int, default=0)
+    p.add_argument('--encoder', default=None,
+                   help='add count and CTR features, saving their tables here')
+    p.add_argument('--crosses', action='store_true',
+                   help='add the hashed feature crosses of ctr.crosses.CROSSES')
+    p.set_defaults(run=features)
+
+    p = commands.add_parser('train', help=train.__doc__)
+    p.add_argument('--features', default='features')
+    p.add_argument('--params', default=None,
+                   help='JSON file of LightGBM params overriding the defaults')
+    p.add_argument('--valid-days', type=int, default=2)
+    p.add_argument('--rounds', type=int, default=4000)
+    p.add_argument('--early-stopping-rounds', type=int, default=500)
+    p.add_argument('--model', default='gbm.txt')
+    p.add_argument('--compiled', default='gbm.npz',
+                   help='also save the model as a tree ensemble for fast scoring')
+    p.add_argument('--full', action='store_true',
+                   help='retrain on all of --src, out of core')
+    p.add_argument('--src', default='train.gz')
+    p.add_argument('--hasher', default='hasher.json')
+    p.add_argument('--bundle', default=None,
+                   help='also save a model bundle with the hasher, encoder and params')
+    p.add_argument('--encoder', default=None,
+                   help='tables saved by features --encoder, for the bundle')
+    p.set_defaults(run=train)
+
+    p = commands.add_parser('predict', help=predict.__doc__)
+    p.add_argument('--model', default='gbm.npz')
+    p.add_argument('--hasher', default='hasher.json',
+                   help='ignored when --model is a bundle')
+    p.add_argument('--src', default='test.gz')
+    p.add_argument('--out', default='submission.csv')
+    p.add_argument('--batch-size', type=int, default=100000)
+    p.add_argument('--workers', type=int, default=None)
+    p.add_argument('--threads', type=int, default=1)
+    p.add_argument('--encoder', default=None,
+                   help='tables saved by features --encoder')
+    p.set_defaults(run=predict)
+
+    # these two pass all their arguments, --help included, on to the
+    # module's own parser
+    p = commands.add_parser('serve', help=serve.__doc__, add_help=False)
+    p.set_defaults(run=serve, forward=True)
+
+    p = commands.add_parser('ftrl', help=ftrl.__doc__, add_help=False)
+    p.set_defaults(run=ftrl, forward=True)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args, rest = parser.parse_known_args(argv)
+    if not getattr(args, 'forward', False):
+        # reports unrecognized arguments
+        args = parser.parse_args(argv)
+    args.rest = rest
+    try:
+        args.run(args)
+    finally:
+        if args.metrics:
+            from ctr.instrument import export
+
+            export(args.metrics)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""Hashed crosses of two or three integer-coded columns.
+
+A cross of ``site_id`` and ``hour_of_day`` is one categorical feature
+whose value is the pair of the two codes, hashed into ``n_buckets``
+buckets.  The codes (the ``_int`` bucket ids written by
+``convert_obj_to_int``, or plain integer columns) are mixed into a 64-bit
+hash arithmetically, a column at a time with the MurmurHash3 finalizer
+used by ``ctr.hashing``, so no per-row strings are built.  Every cross is
+a field of the ``FeatureHasher`` and gets its seed from it, which keeps
+the buckets the same when the saved hasher is used for scoring.
+
+Rows are processed in chunks of ``chunk_size`` so the 64-bit temporaries
+stay small, and every cross is recorded as the stage ``cross:<name>``
+with its time and memory in ``ctr.instrument.recorder``.
+"""
+
+import numpy as np
+
+from ctr.hashing import _FNV_PRIME, fmix64
+from ctr.instrument import stage
+
+# pairs and triples whose click rates differ most in the exploration
+CROSSES = (
+    ('site_id', 'hour_of_day'),
+    ('app_id', 'device_model'),
+    ('device_type', 'hour_of_day'),
+    ('site_id', 'device_model'),
+    ('banner_pos', 'device_type', 'hour_of_day'),
+)
+
+
+def cross_name(columns):
+    return '_x_'.join(columns)
+
+
+def crosses_in(features):
+    """The crosses among a model's ``features``, to rebuild them for scoring."""
+    return [tuple(name.split('_x_')) for name in features if '_x_' in name]
+
+
+def _codes(df, name):
+    # hashed string columns have been renamed by convert_obj_to_int
+    column = df[name] if name in df else df[name + '_int']
+    return np.asarray(column.values)
+
+
+def combine(parts, seed=0):
+    """64-bit hash of the tuple of integer codes in each row of ``parts``."""
+    h = np.full(len(parts[0]), fmix64(np.uint64(seed) ^ _FNV_PRIME), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for codes in parts:
+            h ^= np.asarray(codes).astype(np.int64).view(np.uint64)
+            h *= _FNV_PRIME
+            h = fmix64(h)
+    return h
+
+
+def cross_column(df, columns, hasher, n_buckets=None, chunk_size=1000000, out=None):
+    """Bucket ids of the cross of ``columns`` of ``df``."""
+    n_buckets = np.uint64(n_buckets or hasher.n_buckets)
+    seed = hasher.field_seed(cross_name(columns))
+    parts = [_codes(df, name) for name in columns]
+    if out is None:
+        out = np.empty(len(df), dtype=np.int32 if n_buckets <= 2**31 else np.int64)
+    for lo in range(0, len(df), chunk_size):
+        chunk = [p[lo:lo + chunk_size] for p in parts]
+        np.remainder(combine(chunk, seed), n_buckets, out=out[lo:lo + chunk_size],
+                     casting='unsafe')
+    return out
+
+
+def add_crosses(df, hasher, crosses=CROSSES, n_buckets=None, chunk_size=1000000):
+    """Add a column ``a_x_b`` (or ``a_x_b_x_c``) to ``df`` for every cross.
+
+    Run after ``convert_obj_to_int`` with the same ``hasher``, on training
+    and scoring data alike.  ``n_buckets`` defaults to the hasher's.
+    """
+    for columns in crosses:
+        name = cross_name(columns)
+        with stage('cross:' + name, rows=len(df)):
+            df[name] = cross_column(df, columns, hasher, n_buckets, chunk_size)
+    return df
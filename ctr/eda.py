@@ -0,0 +1,91 @@
+"""Aggregations behind the exploratory analysis of the clickstream."""
+
+import numpy as np
+import pandas as pd
+
+from ctr.instrument import stage
+
+
+def factorize(values):
+    """Integer codes ``>= -1`` and the unique values they index.
+
+    Categoricals reuse their codes, small-range integer columns are offset
+    by their minimum, and anything else goes through ``pd.factorize``.
+    Missing values get code -1.
+    """
+    if isinstance(values, pd.Series):
+        values = values.array
+    if isinstance(values, pd.Categorical):
+        return np.asarray(values.codes), np.asarray(values.categories)
+    values = np.asarray(values)
+    if values.dtype.kind in 'biu' and len(values):
+        lo, hi = int(values.min()), int(values.max())
+        if hi - lo < max(len(values), 1 << 16):
+            return (values - lo).astype(np.intp), np.arange(lo, hi + 1, dtype=values.dtype)
+    codes, uniques = pd.factorize(values, sort=True)
+    return codes, np.asarray(uniques)
+
+
+def count_clicks(codes, clicks, size):
+    """Impressions and clicks per code, one ``np.bincount`` each."""
+    if len(codes) and codes.min() < 0:
+        keep = codes >= 0
+        codes, clicks = codes[keep], clicks[keep]
+    impressions = np.bincount(codes, minlength=size)
+    clicked = np.bincount(codes, weights=clicks, minlength=size).astype(np.int64)
+    return impressions, clicked
+
+
+def ctr_table(df, column, target='click'):
+    """Impressions, clicks and CTR (in percent) for every value of ``column``."""
+    return ctr_tables(df, [column], target)[column]
+
+
+def ctr_tables(df, columns, target='click'):
+    """``ctr_table`` for each of ``columns``, returned as a dict.
+
+    Each table is computed with one pass over the column's integer codes,
+    without grouping or filtering the frame.
+    """
+    with stage('aggregate', rows=len(df)):
+        clicks = np.asarray(df[target].values, dtype=np.float64)
+        tables = {}
+        for column in columns:
+            codes, uniques = factorize(df[column])
+            impressions, clicked = count_clicks(codes, clicks, len(uniques))
+            seen = impressions > 0
+            table = pd.DataFrame({column: uniques[seen],
+                                  'impressions': impressions[seen],
+                                  'clicks': clicked[seen]})
+            table['CTR'] = table['clicks'] / table['impressions'] * 100
+            tables[column] = table.sort_values(column, ignore_index=True)
+        return tables
+
+
+def top_k_ctr(df, columns, k=10, target='click'):
+    """Frequency and CTR of the ``k`` most frequent values of each column.
+
+    Returns a dict of tables with the value, its impressions, its ``share``
+    of all rows, clicks and CTR (in percent), most frequent first.  Each
+    column takes one pass over its codes regardless of its cardinality;
+    ``k=None`` keeps every value.
+    """
+    with stage('aggregate', rows=len(df)):
+        clicks = np.asarray(df[target].values, dtype=np.float64)
+        tables = {}
+        for column in columns:
+            codes, uniques = factorize(df[column])
+            impressions, clicked = count_clicks(codes, clicks, len(uniques))
+            if k is not None and k < len(uniques):
+                top = np.argpartition(-impressions, k)[:k]
+            else:
+                top = np.flatnonzero(impressions)
+            top = top[np.argsort(-impressions[top], kind='stable')]
+            top = top[impressions[top] > 0]
+            table = pd.DataFrame({column: uniques[top],
+                                  'impressions': impressions[top],
+                                  'share': impressions[top] / len(df),
+                                  'clicks': clicked[top]})
+            table['CTR'] = table['clicks'] / table['impressions'] * 100
+            tables[column] = table
+        return tables
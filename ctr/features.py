@@ -0,0 +1,89 @@
+"""Feature engineering shared by training and prediction."""
+
+import numpy as np
+
+from ctr.crosses import add_crosses
+from ctr.hashing import FeatureHasher
+from ctr.instrument import instrumented
+
+# bump whenever a change here alters the encoded output, so cached frames
+# built by an older version are not reused
+ENCODER_VERSION = 2
+
+DAY_NAMES = np.array(['Monday', 'Tuesday', 'Wednesday', 'Thursday',
+                      'Friday', 'Saturday', 'Sunday'], dtype=object)
+
+
+def decode_hour(values):
+    """Decode ``YYMMDDHH`` integers into timestamps, hour of day and weekday.
+
+    The integer is split arithmetically, so the whole column is converted in
+    a handful of vectorized NumPy operations instead of one ``strptime`` call
+    per row.  Returns ``(hour, hour_of_day, day_of_week)`` where ``hour`` is a
+    ``datetime64[h]`` array and ``day_of_week`` is 0 for Monday.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    year = values // 1000000 + 2000
+    month = values // 10000 % 100
+    day = values // 100 % 100
+    hour_of_day = (values % 100).astype(np.int8)
+
+    months = (year - 1970) * 12 + (month - 1)
+    days = months.astype('datetime64[M]').astype('datetime64[D]') + (day - 1)
+    hour = days.astype('datetime64[h]') + hour_of_day.astype('timedelta64[h]')
+    # 1970-01-01 was a Thursday
+    day_of_week = ((days.astype(np.int64) + 3) % 7).astype(np.int8)
+    return hour, hour_of_day, day_of_week
+
+
+def hour_key(values):
+    """``YYMMDDHH`` integers for raw hour values or decoded timestamps."""
+    values = np.asarray(values)
+    if values.dtype.kind != 'M':
+        return values.astype(np.int64)
+    days = values.astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+    hour_of_day = (values - days).astype('timedelta64[h]').astype(np.int64)
+    day = (days - months).astype(np.int64) + 1
+    month = (months - years).astype(np.int64) + 1
+    year = years.astype(np.int64) + 1970
+    return (year % 100) * 1000000 + month * 10000 + day * 100 + hour_of_day
+
+
+def add_time_features(df, column='hour'):
+    """Replace the raw ``YYMMDDHH`` column of ``df`` and add derived columns."""
+    hour, hour_of_day, day_of_week = decode_hour(df[column].values)
+    df[column] = hour
+    df['hour_of_day'] = hour_of_day
+    df['day_of_week'] = DAY_NAMES[day_of_week]
+    return df
+
+
+@instrumented('encode', rows=len)
+def convert_obj_to_int(df, hasher=None):
+    """Replace each string column ``c`` of ``df`` by hashed bucket ids ``c_int``.
+
+    Pass the same ``hasher`` when transforming training and scoring data.
+    """
+    if hasher is None:
+        hasher = FeatureHasher()
+    return hasher.transform(df, suffix='_int')
+
+
+def encode_frame(df, hasher, drop=('hour',), encoder=None, crosses=()):
+    """Apply the training transforms to a freshly parsed batch.
+
+    Decodes the hour column, adds the count and CTR features of
+    ``encoder`` (a fitted ``TargetEncoder``) if given, hashes the string
+    columns with ``hasher``, adds the feature ``crosses`` and drops the
+    columns in ``drop``; used for every batch that is scored, so it must
+    match what was done to the training frame.
+    """
+    df = add_time_features(df)
+    if encoder is not None:
+        df = encoder.transform(df)
+    df = convert_obj_to_int(df, hasher)
+    if crosses:
+        df = add_crosses(df, hasher, crosses)
+    return df.drop(columns=[c for c in drop if c in df])
@@ -0,0 +1,296 @@
+"""Field-aware factorization machines on hashed field/feature indices.
+
+Rows are encoded as in ``ctr.ftrl``: one hashed index per field, each
+field with its own hash seed.  Every index has a ``k``-dimensional latent
+vector per other field, and the score of a row is the sum over field pairs
+``(a, b)`` of ``<w[x_a, b], w[x_b, a]>``, normalized by the number of
+fields.  Training is AdaGrad SGD as in libffm.  With Numba the rows of a
+batch are processed in parallel by a lock-free (Hogwild) kernel: threads
+update the shared weights without synchronization, which costs little
+because two rows rarely share many indices.  Without Numba a vectorized
+NumPy minibatch update is used.
+
+``fit_file`` streams ``train.gz`` once, holding out rows from the hour
+``valid_from`` on for validation, and caches the encoded training rows on
+disk so that later epochs read a memory map instead of parsing the csv
+again.  Training stops when the validation ``binary_logloss`` (the metric
+``lgb.train`` reports) has not improved for ``early_stopping_rounds``
+epochs, and the best weights are kept.
+"""
+
+import functools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from ctr.cache import CACHE_DIR
+from ctr.features import hour_key
+from ctr.ftrl import FIELDS, _logloss, encode_batch
+from ctr.hashing import FeatureHasher
+from ctr.ingest import bounded_map, parse_batch, read_batches
+from ctr.instrument import stage
+from ctr.schema import compact_types, types_train
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _pairs(n_fields):
+    a, b = np.triu_indices(n_fields, 1)
+    return a.astype(np.int64), b.astype(np.int64)
+
+
+def _phi_numpy(W, idx):
+    n_fields = idx.shape[1]
+    a, b = _pairs(n_fields)
+    wa = W[idx[:, a], b]
+    wb = W[idx[:, b], a]
+    return (wa * wb).sum(axis=(1, 2)) / n_fields, a, b, wa, wb
+
+
+def _fit_numpy(W, G, idx, y, eta, lam, minibatch=1024):
+    n_fields = idx.shape[1]
+    loss = 0.0
+    for lo in range(0, len(idx), minibatch):
+        block, target = idx[lo:lo + minibatch], y[lo:lo + minibatch]
+        phi, a, b, wa, wb = _phi_numpy(W, block)
+        p = 1.0 / (1.0 + np.exp(-np.clip(phi, -35, 35)))
+        loss += _logloss(p, target).sum()
+        kappa = (p - target)[:, None, None] / n_fields
+        ga = lam * wa + kappa * wb
+        gb = lam * wb + kappa * wa
+        # (feature, field) of every latent vector touched, and its gradient
+        feature = np.concatenate([block[:, a], block[:, b]], axis=1).ravel()
+        field = np.tile(np.concatenate([b, a]), len(block))
+        grad = np.concatenate([ga, gb], axis=1).reshape(-1, W.shape[2])
+        np.add.at(G, (feature, field), grad * grad)
+        np.add.at(W, (feature, field), -eta * grad / np.sqrt(G[feature, field]))
+    return loss
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _phi_rows(W, idx, out):
+        n_fields = idx.shape[1]
+        k = W.shape[2]
+        for r in numba.prange(idx.shape[0]):
+            phi = 0.0
+            for a in range(n_fields):
+                ia = idx[r, a]
+                for b in range(a + 1, n_fields):
+                    ib = idx[r, b]
+                    for d in range(k):
+                        phi += W[ia, b, d] * W[ib, a, d]
+            out[r] = phi / n_fields
+
+    @numba.njit(parallel=True, cache=True)
+    def _fit_rows(W, G, idx, y, eta, lam):
+        # Hogwild: rows run in parallel and update W and G without locks
+        n_fields = idx.shape[1]
+        k = W.shape[2]
+        losses = np.zeros(idx.shape[0])
+        for r in numba.prange(idx.shape[0]):
+            phi = 0.0
+            for a in range(n_fields):
+                ia = idx[r, a]
+                for b in range(a + 1, n_fields):
+                    ib = idx[r, b]
+                    for d in range(k):
+                        phi += W[ia, b, d] * W[ib, a, d]
+            phi = min(max(phi / n_fields, -35.0), 35.0)
+            p = 1.0 / (1.0 + np.exp(-phi))
+            pc = min(max(p, 1e-15), 1 - 1e-15)
+            losses[r] = -(y[r] * np.log(pc) + (1 - y[r]) * np.log(1 - pc))
+            kappa = (p - y[r]) / n_fields
+            for a in range(n_fields):
+                ia = idx[r, a]
+                for b in range(a + 1, n_fields):
+                    ib = idx[r, b]
+                    for d in range(k):
+                        wa = W[ia, b, d]
+                        wb = W[ib, a, d]
+                        ga = lam * wa + kappa * wb
+                        gb = lam * wb + kappa * wa
+                        G[ia, b, d] += ga * ga
+                        G[ib, a, d] += gb * gb
+                        W[ia, b, d] = wa - eta * ga / np.sqrt(G[ia, b, d])
+                        W[ib, a, d] = wb - eta * gb / np.sqrt(G[ib, a, d])
+        return losses.sum()
+
+
+def _encode_rows(df, hasher, fields):
+    hours = hour_key(df['hour'].values)
+    _, idx, y = encode_batch(df, hasher, fields)
+    # the last column of ``encode_batch`` is FTRL's bias slot
+    return hours, np.ascontiguousarray(idx[:, :-1]), y
+
+
+class FFM(object):
+    """Field-aware factorization machine with ``k`` latent factors.
+
+    ``eta`` is the AdaGrad learning rate and ``lam`` the L2 penalty.
+    Weights take ``n_buckets * len(fields) * k`` float32 values, and as
+    much again for the AdaGrad accumulators.
+    """
+
+    def __init__(self, k=4, eta=0.2, lam=2e-5, n_buckets=2**18, seed=0,
+                 fields=FIELDS, hasher=None, threads=None):
+        self.hasher = hasher or FeatureHasher(n_buckets, seed)
+        self.fields = tuple(fields)
+        self.k, self.eta, self.lam = k, eta, lam
+        self.seed = seed
+        self.threads = threads
+        shape = (self.hasher.n_buckets, len(self.fields), k)
+        rng = np.random.RandomState(seed)
+        self.W = (rng.uniform(0, 1, shape) / np.sqrt(k)).astype(np.float32)
+        self.G = np.ones(shape, dtype=np.float32)
+        self.best_iteration = 0
+        self.best_score = None
+        self.evals_result = {'binary_logloss': []}
+
+    def fit_indices(self, idx, y):
+        """One pass of SGD over ``idx`` rows; returns their summed logloss."""
+        if numba is not None:
+            if self.threads:
+                # set_num_threads rejects more than the pool was started with
+                numba.set_num_threads(min(self.threads, numba.config.NUMBA_NUM_THREADS))
+            return _fit_rows(self.W, self.G, idx, y, self.eta, self.lam)
+        return _fit_numpy(self.W, self.G, idx, y, self.eta, self.lam)
+
+    def predict_indices(self, idx):
+        if numba is not None:
+            phi = np.empty(len(idx))
+            _phi_rows(self.W, idx, phi)
+        else:
+            phi = np.concatenate([_phi_numpy(self.W, idx[lo:lo + 4096])[0]
+                                  for lo in range(0, len(idx), 4096)] or [[]])
+        return 1.0 / (1.0 + np.exp(-phi))
+
+    def predict(self, df):
+        """Click probabilities for a frame of raw ``types_test`` columns."""
+        return self.predict_indices(_encode_rows(df, self.hasher, self.fields)[1])
+
+    def fit(self, batches, valid=None, epochs=10, early_stopping_rounds=2,
+            log=sys.stderr):
+        """Train on ``batches()``, an iterable of ``(idx, y)`` made anew per epoch.
+
+        With ``valid = (idx, y)``, or a function returning it, the validation
+        logloss is computed after every epoch, and training stops once it
+        has not improved for ``early_stopping_rounds`` epochs; the weights
+        of the best epoch are restored.
+        """
+        best = None
+        for epoch in range(1, epochs + 1):
+            start, rows, loss = time.time(), 0, 0.0
+            with stage('ffm_train') as record:
+                for idx, y in batches():
+                    loss += self.fit_indices(idx, y)
+                    rows += len(idx)
+                record['rows'] = rows
+            message = 'epoch %d: train logloss %.5f, %.0f rows/s' % (
+                epoch, loss / max(rows, 1), rows / (time.time() - start))
+            if callable(valid):
+                valid = valid()
+            if valid is not None:
+                score = float(_logloss(self.predict_indices(valid[0]), valid[1]).mean())
+                self.evals_result['binary_logloss'].append(score)
+                message += ", valid binary_logloss %.5f" % score
+                if self.best_score is None or score < self.best_score:
+                    self.best_score, self.best_iteration = score, epoch
+                    best = (self.W.copy(), self.G.copy())
+            if log is not None:
+                log.write(message + '\n')
+            if valid is not None and epoch - self.best_iteration >= early_stopping_rounds:
+                break
+        if best is not None:
+            self.W, self.G = best
+        return self
+
+    def fit_file(self, src='train.gz', valid_from=None, epochs=10,
+                 early_stopping_rounds=2, batch_size=100000, workers=None,
+                 cache_dir=CACHE_DIR, log=sys.stderr):
+        """Train on a clickstream csv, validating on rows from ``valid_from`` on.
+
+        ``valid_from`` is an hour as ``YYMMDDHH``.  The first epoch parses
+        ``src`` on ``workers`` processes and appends the encoded training
+        rows to a file under ``cache_dir``; later epochs read that file in
+        ``batch_size`` row slices.  Validation rows are kept in memory.
+        """
+        directory = os.path.join(cache_dir, 'ffm')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        base = os.path.join(directory, '%s-%d' % (os.path.basename(src), os.getpid()))
+        parse = functools.partial(parse_batch, dtype=compact_types(types_train),
+                                  transform=functools.partial(
+                                      _encode_rows, hasher=self.hasher,
+                                      fields=self.fields))
+        valid_idx, valid_y = [], []
+        epochs_run = [0]
+
+        def stream():
+            rows = 0
+            with open(base + '.idx', 'wb') as fx, open(base + '.y', 'wb') as fy:
+                for hours, idx, y in bounded_map(parse, read_batches(src, batch_size),
+                                                 workers=workers):
+                    if valid_from is not None:
+                        held_out = hours >= valid_from
+                        valid_idx.append(idx[held_out])
+                        valid_y.append(y[held_out])
+                        idx, y = idx[~held_out], y[~held_out]
+                    fx.write(idx.tobytes())
+                    fy.write(y.tobytes())
+                    rows += len(idx)
+                    yield idx, y
+            epochs_run[0] = rows
+
+        def replay():
+            rows = epochs_run[0]
+            X = np.memmap(base + '.idx', dtype=np.int32, mode='r',
+                          shape=(rows, len(self.fields)))
+            Y = np.memmap(base + '.y', dtype=np.float32, mode='r', shape=(rows,))
+            for lo in range(0, rows, batch_size):
+                yield np.asarray(X[lo:lo + batch_size]), np.asarray(Y[lo:lo + batch_size])
+
+        def valid():
+            if not sum(len(v) for v in valid_y):
+                return None
+            return np.concatenate(valid_idx), np.concatenate(valid_y)
+
+        try:
+            self.fit(lambda: replay() if epochs_run[0] else stream(),
+                     valid if valid_from is not None else None,
+                     epochs, early_stopping_rounds, log)
+        finally:
+            for ext in ('.idx', '.y'):
+                if os.path.exists(base + ext):
+                    os.remove(base + ext)
+        return self
+
+    def save(self, path):
+        meta = {'k': self.k, 'eta': self.eta, 'lam': self.lam,
+                'fields': list(self.fields), 'hasher': self.hasher.to_dict(),
+                'best_iteration': self.best_iteration,
+                'best_score': self.best_score}
+        np.savez(path, W=self.W, meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, path):
+        """A model for scoring; the AdaGrad state is not saved."""
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            W = f['W']
+        model = cls.__new__(cls)
+        model.hasher = FeatureHasher.from_dict(meta['hasher'])
+        model.fields = tuple(meta['fields'])
+        model.k, model.eta, model.lam = meta['k'], meta['eta'], meta['lam']
+        model.threads = None
+        model.W, model.G = W, None
+        model.best_iteration = meta['best_iteration']
+        model.best_score = meta['best_score']
+        model.evals_result = {'binary_logloss': []}
+        return model
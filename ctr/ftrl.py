@@ -0,0 +1,285 @@
+"""Online logistic regression with FTRL-Proximal on hashed one-hot features.
+
+Every field of a row is hashed into one shared weight space of
+``n_buckets`` slots (plus a bias slot), so a row is a short list of active
+indices and the model state is two float64 arrays, ``z`` and ``n``, whose
+size does not depend on the amount of data; scoring uses the weights as
+one float32 array.  ``fit_file`` makes a single streaming pass over
+``train.gz``: batches are parsed and hashed on a process pool while the
+main process updates the weights, and the state can be checkpointed and
+resumed part way through the file.
+
+With Numba installed the updates are applied row by row exactly as in
+McMahan et al. (2013); without it rows are applied in small minibatches,
+which sums the gradients of rows sharing an index.  The reported loss is
+the progressive validation logloss, measured on each row before the model
+learns from it.
+
+    python -m ctr.ftrl train --src train.gz --model ftrl.npz
+    python -m ctr.ftrl predict --model ftrl.npz --src test.gz --out ftrl.csv
+"""
+
+import argparse
+import functools
+import gzip
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from ctr.features import decode_hour
+from ctr.hashing import FeatureHasher
+from ctr.ingest import bounded_map, parse_batch, read_batches
+from ctr.instrument import stage
+from ctr.schema import compact_types, types_test, types_train
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# every raw column but the row id, the label and the timestamp, plus the
+# two derived time fields
+FIELDS = tuple(c for c in types_train if c not in ('id', 'click', 'hour')) + (
+    'hour_of_day', 'day_of_week')
+
+
+def encode_batch(df, hasher, fields=FIELDS):
+    """Active weight indices of each row, and the labels if ``df`` has them.
+
+    Returns ``(ids, idx, y)``: ``idx`` has one column per field plus a last
+    column pointing at the bias slot ``hasher.n_buckets``.
+    """
+    _, hour_of_day, day_of_week = decode_hour(df['hour'].values)
+    derived = {'hour_of_day': hour_of_day, 'day_of_week': day_of_week}
+    idx = np.empty((len(df), len(fields) + 1), dtype=np.int32)
+    for j, name in enumerate(fields):
+        values = derived[name] if name in derived else df[name]
+        hasher.hash_column(name, values, out=idx[:, j])
+    idx[:, -1] = hasher.n_buckets
+    y = df['click'].values.astype(np.float32) if 'click' in df else None
+    return df['id'].values.astype(np.uint64), idx, y
+
+
+def _weights(z, n, alpha, beta, l1, l2):
+    w = -(z - np.sign(z) * l1) / ((beta + np.sqrt(n)) / alpha + l2)
+    w[np.abs(z) <= l1] = 0.0
+    return w
+
+
+def _logloss(p, y):
+    # in float64: 1 - 1e-15 rounds to 1 in float32
+    p = np.clip(np.asarray(p, dtype=np.float64), 1e-15, 1 - 1e-15)
+    return -(y * np.log(p) + (1 - y) * np.log(1 - p))
+
+
+def _fit_numpy(idx, y, z, n, alpha, beta, l1, l2, minibatch=1024):
+    loss = 0.0
+    for lo in range(0, len(idx), minibatch):
+        block, target = idx[lo:lo + minibatch], y[lo:lo + minibatch]
+        slots, inverse = np.unique(block, return_inverse=True)
+        inverse = inverse.reshape(block.shape)
+        zs, ns = z[slots], n[slots]
+        w = _weights(zs, ns, alpha, beta, l1, l2)
+        p = 1.0 / (1.0 + np.exp(-np.clip(w[inverse].sum(axis=1), -35, 35)))
+        loss += _logloss(p, target).sum()
+        g = np.repeat(p - target, block.shape[1])
+        grad = np.bincount(inverse.ravel(), weights=g, minlength=len(slots))
+        grad2 = np.bincount(inverse.ravel(), weights=g * g, minlength=len(slots))
+        sigma = (np.sqrt(ns + grad2) - np.sqrt(ns)) / alpha
+        z[slots] = zs + grad - sigma * w
+        n[slots] = ns + grad2
+    return loss
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _fit_rows(idx, y, z, n, alpha, beta, l1, l2):
+        loss = 0.0
+        k = idx.shape[1]
+        w = np.empty(k)
+        for r in range(idx.shape[0]):
+            margin = 0.0
+            for j in range(k):
+                i = idx[r, j]
+                zi = z[i]
+                if abs(zi) <= l1:
+                    w[j] = 0.0
+                else:
+                    w[j] = -(zi - np.sign(zi) * l1) / ((beta + np.sqrt(n[i])) / alpha + l2)
+                margin += w[j]
+            margin = min(max(margin, -35.0), 35.0)
+            p = 1.0 / (1.0 + np.exp(-margin))
+            pc = min(max(p, 1e-15), 1 - 1e-15)
+            loss -= y[r] * np.log(pc) + (1 - y[r]) * np.log(1 - pc)
+            g = p - y[r]
+            for j in range(k):
+                i = idx[r, j]
+                ni = n[i]
+                sigma = (np.sqrt(ni + g * g) - np.sqrt(ni)) / alpha
+                z[i] += g - sigma * w[j]
+                n[i] = ni + g * g
+        return loss
+
+
+class FTRL(object):
+    """FTRL-Proximal logistic regression over hashed fields.
+
+    ``alpha`` and ``beta`` set the per-coordinate learning rate
+    ``alpha / (beta + sqrt(n))``; ``l1`` and ``l2`` regularize the weights,
+    ``l1`` keeping most of them at exactly zero.
+    """
+
+    def __init__(self, alpha=0.05, beta=1.0, l1=1.0, l2=1.0, n_buckets=2**24,
+                 seed=0, fields=FIELDS, hasher=None):
+        self.hasher = hasher or FeatureHasher(n_buckets, seed)
+        self.fields = tuple(fields)
+        self.alpha, self.beta, self.l1, self.l2 = alpha, beta, l1, l2
+        # float64: over 40M rows the squared gradient sums of the bias and
+        # frequent slots grow past where float32 can still add to them
+        self.z = np.zeros(self.hasher.n_buckets + 1, dtype=np.float64)
+        self.n = np.zeros(self.hasher.n_buckets + 1, dtype=np.float64)
+        self.rows = 0
+        self.loss = 0.0
+        self._w = None
+
+    def fit_indices(self, idx, y):
+        """Learn from rows given as index arrays; returns their summed logloss."""
+        args = (idx, y, self.z, self.n, self.alpha, self.beta, self.l1, self.l2)
+        loss = _fit_rows(*args) if numba is not None else _fit_numpy(*args)
+        self.rows += len(idx)
+        self.loss += loss
+        self._w = None
+        return loss
+
+    def fit_file(self, src='train.gz', batch_size=100000, workers=None,
+                 checkpoint=None, checkpoint_rows=5000000, max_rows=None,
+                 log=sys.stderr):
+        """One streaming pass over ``src``, continuing after ``self.rows``.
+
+        Batches are parsed and hashed by ``workers`` processes.  With
+        ``checkpoint`` set the state is saved there every
+        ``checkpoint_rows`` rows and at the end; a model loaded from the
+        checkpoint skips the rows it has already seen, which must be a
+        whole number of batches.
+        """
+        if self.rows % batch_size:
+            raise ValueError('resuming after %d rows needs a batch_size dividing it'
+                             % self.rows)
+        batches = itertools.islice(read_batches(src, batch_size),
+                                   self.rows // batch_size, None)
+        parse = functools.partial(parse_batch, dtype=compact_types(types_train),
+                                  transform=functools.partial(
+                                      encode_batch, hasher=self.hasher,
+                                      fields=self.fields))
+        start, seen, saved = time.time(), 0, self.rows
+        with stage('ftrl_train') as record:
+            for _, idx, y in bounded_map(parse, batches, workers=workers):
+                loss = self.fit_indices(idx, y)
+                seen += len(idx)
+                if log is not None:
+                    log.write('%d rows, logloss %.5f (batch %.5f), %.0f rows/s\n' % (
+                        self.rows, self.loss / self.rows, loss / len(idx),
+                        seen / (time.time() - start)))
+                if checkpoint is not None and self.rows - saved >= checkpoint_rows:
+                    self.save(checkpoint)
+                    saved = self.rows
+                if max_rows is not None and seen >= max_rows:
+                    break
+            record['rows'] = seen
+        if checkpoint is not None:
+            self.save(checkpoint)
+        return self
+
+    def weights(self):
+        """Dense float32 weights, computed once per state for scoring."""
+        if self._w is None:
+            self._w = _weights(self.z, self.n, self.alpha, self.beta,
+                               self.l1, self.l2).astype(np.float32)
+        return self._w
+
+    def predict_indices(self, idx):
+        margin = self.weights()[idx].sum(axis=1, dtype=np.float64)
+        return 1.0 / (1.0 + np.exp(-margin))
+
+    def predict(self, df):
+        """Click probabilities for a frame of raw ``types_test`` columns."""
+        return self.predict_indices(encode_batch(df, self.hasher, self.fields)[1])
+
+    def predict_file(self, src='test.gz', out='ftrl.csv', batch_size=100000,
+                     workers=None):
+        """Write ``id,click`` probabilities for every row of ``src``."""
+        parse = functools.partial(parse_batch, dtype=compact_types(types_test),
+                                  transform=functools.partial(
+                                      encode_batch, hasher=self.hasher,
+                                      fields=self.fields))
+        opener = gzip.open if out.endswith('.gz') else open
+        rows = 0
+        with stage('ftrl_predict') as record, opener(out, 'wt') as f:
+            f.write('id,click\n')
+            for ids, idx, _ in bounded_map(parse, read_batches(src, batch_size),
+                                           workers=workers):
+                p = self.predict_indices(idx)
+                f.writelines('%d,%.6f\n' % row for row in zip(ids.tolist(), p.tolist()))
+                rows += len(ids)
+            record['rows'] = rows
+        return rows
+
+    def save(self, path):
+        """Write the full training state; replaces ``path`` atomically."""
+        meta = {'alpha': self.alpha, 'beta': self.beta, 'l1': self.l1,
+                'l2': self.l2, 'fields': list(self.fields),
+                'hasher': self.hasher.to_dict(), 'rows': self.rows,
+                'loss': self.loss}
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, z=self.z, n=self.n, meta=np.array(json.dumps(meta)))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            model = cls(meta['alpha'], meta['beta'], meta['l1'], meta['l2'],
+                        fields=meta['fields'],
+                        hasher=FeatureHasher.from_dict(meta['hasher']))
+            model.z[:] = f['z']
+            model.n[:] = f['n']
+        model.rows, model.loss = meta['rows'], meta['loss']
+        return model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['train', 'predict'])
+    parser.add_argument('--model', default='ftrl.npz')
+    parser.add_argument('--src', default=None)
+    parser.add_argument('--out', default='ftrl.csv')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the state saved in --model')
+    parser.add_argument('--buckets', type=int, default=2 ** 24)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--beta', type=float, default=1.0)
+    parser.add_argument('--l1', type=float, default=1.0)
+    parser.add_argument('--l2', type=float, default=1.0)
+    parser.add_argument('--batch-size', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == 'train':
+        if args.resume:
+            model = FTRL.load(args.model)
+        else:
+            model = FTRL(args.alpha, args.beta, args.l1, args.l2, args.buckets)
+        model.fit_file(args.src or 'train.gz', args.batch_size, args.workers,
+                       checkpoint=args.model)
+    else:
+        model = FTRL.load(args.model)
+        model.predict_file(args.src or 'test.gz', args.out, args.batch_size,
+                           args.workers)
+
+
+if __name__ == '__main__':
+    main()
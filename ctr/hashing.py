@@ -0,0 +1,129 @@
+"""Deterministic, vectorized feature hashing.
+
+Python's built-in ``hash`` of a string is salted per process by
+``PYTHONHASHSEED``, so codes produced during training do not match the ones
+produced when scoring.  The hashes here are a seeded 64-bit FNV-1a over the
+UTF-8 bytes followed by the MurmurHash3 finalizer, computed for whole arrays
+at once, and are identical on every machine and in every process.
+"""
+
+import numpy as np
+import pandas as pd
+
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+_M1 = np.uint64(0xff51afd7ed558ccd)
+_M2 = np.uint64(0xc4ceb9fe1a85ec53)
+
+
+def fmix64(h):
+    """MurmurHash3 64-bit finalizer, applied elementwise to uint64 values."""
+    with np.errstate(over='ignore'):
+        h = h ^ (h >> np.uint64(33))
+        h = h * _M1
+        h = h ^ (h >> np.uint64(33))
+        h = h * _M2
+        return h ^ (h >> np.uint64(33))
+
+
+def hash_strings(values, seed=0):
+    """Hash an array of strings (or bytes) to uint64."""
+    values = np.asarray(values)
+    if values.dtype.kind != 'S':
+        try:
+            values = values.astype('S')
+        except UnicodeEncodeError:
+            values = np.char.encode(values.astype(str), 'utf-8')
+    values = np.ascontiguousarray(values)
+    n, width = len(values), values.dtype.itemsize
+    data = values.view(np.uint8).reshape(n, width)
+    h = np.full(n, _FNV_OFFSET ^ fmix64(np.uint64(seed)), dtype=np.uint64)
+    for j in range(width):
+        byte = data[:, j].astype(np.uint64)
+        # fixed-width arrays are NUL padded; skipping NULs makes the hash
+        # independent of the width of the array a string arrives in
+        h = np.where(byte != 0, (h ^ byte) * _FNV_PRIME, h)
+    return fmix64(h)
+
+
+def hash_ints(values, seed=0):
+    """Hash an array of integers to uint64."""
+    values = np.asarray(values).astype(np.int64).view(np.uint64)
+    return fmix64(values ^ fmix64(np.uint64(seed) ^ _FNV_PRIME))
+
+
+def hash_values(values, seed=0):
+    """Hash strings, categoricals or integers to uint64.
+
+    Repeated values are only hashed once: categoricals hash their
+    categories, and other non-numeric columns are factorized first.
+    """
+    if isinstance(values, (pd.Series, pd.Index)):
+        values = values.array
+    if isinstance(values, pd.Categorical):
+        codes, uniques = values.codes, values.categories
+    elif np.asarray(values).dtype.kind in 'biu':
+        return hash_ints(values, seed)
+    else:
+        codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques)
+    if uniques.dtype.kind in 'biu':
+        hashed = hash_ints(uniques, seed)
+    else:
+        hashed = hash_strings(uniques, seed)
+    # missing values (code -1) all share the hash of the empty string
+    hashed = np.append(hashed, hash_strings(np.array([b'']), seed))
+    return hashed[codes]
+
+
+def is_string_column(dtype):
+    return (dtype == object or isinstance(dtype, pd.StringDtype)
+            or isinstance(dtype, pd.CategoricalDtype))
+
+
+class FeatureHasher(object):
+    """Map the string columns of a frame to integer buckets.
+
+    Every field gets its own seed, derived from ``seed`` and the field name
+    unless given explicitly in ``seeds``, so equal values in different
+    fields land in unrelated buckets.  The same instance (or one rebuilt
+    from ``to_dict``) must be used for training and prediction.
+    """
+
+    def __init__(self, n_buckets=2**24, seed=0, seeds=None):
+        self.n_buckets = int(n_buckets)
+        self.seed = int(seed)
+        self.seeds = dict(seeds or {})
+
+    def field_seed(self, name):
+        if name not in self.seeds:
+            self.seeds[name] = int(hash_strings(np.array([name]), self.seed)[0]
+                                   >> np.uint64(32))
+        return self.seeds[name]
+
+    def hash_column(self, name, values, out=None):
+        """Bucket ids of ``values`` for field ``name``, written into ``out``."""
+        if out is None:
+            dtype = np.int32 if self.n_buckets <= 2**31 else np.int64
+            out = np.empty(len(values), dtype=dtype)
+        np.remainder(hash_values(values, self.field_seed(name)),
+                     np.uint64(self.n_buckets), out=out, casting='unsafe')
+        return out
+
+    def transform(self, df, columns=None, suffix='_int'):
+        """Replace each string column ``c`` of ``df`` by bucket ids ``c + suffix``."""
+        if columns is None:
+            columns = [c for c, dtype in df.dtypes.items()
+                       if is_string_column(dtype)]
+        for name in columns:
+            df[name + suffix] = self.hash_column(name, df[name])
+            df.drop(columns=[name], inplace=True)
+        return df
+
+    def to_dict(self):
+        return {'n_buckets': self.n_buckets, 'seed': self.seed,
+                'seeds': dict(self.seeds)}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(**state)
@@ -0,0 +1,186 @@
+"""Loading the gzip-compressed clickstream files."""
+
+import collections
+import functools
+import gzip
+import io
+import itertools
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from ctr.features import add_time_features
+from ctr.instrument import instrumented
+from ctr.schema import compact_types, narrow_ints, types_train
+
+
+def _open(path):
+    if hasattr(path, 'read'):
+        return path
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _uniform(rng):
+    # log() of the draw is taken below, so exclude 0.0
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+
+def reservoir_sample(lines, sample_size, seed=None):
+    """Uniformly sample ``sample_size`` items from an iterable of unknown length.
+
+    Uses Algorithm L, so the random number generator is only consulted when
+    an item enters the reservoir rather than once per item.  The sample is
+    returned in its original stream order.
+    """
+    rng = random.Random(seed)
+    it = enumerate(lines)
+    reservoir = list(itertools.islice(it, sample_size))
+    if len(reservoir) == sample_size > 0:
+        w = math.exp(math.log(_uniform(rng)) / sample_size)
+        while True:
+            skip = int(math.log(_uniform(rng)) / math.log1p(-w))
+            item = next(itertools.islice(it, skip, None), None)
+            if item is None:
+                break
+            reservoir[rng.randrange(sample_size)] = item
+            w *= math.exp(math.log(_uniform(rng)) / sample_size)
+        reservoir.sort(key=lambda item: item[0])
+    return [line for _, line in reservoir]
+
+
+def bernoulli_sample(lines, fraction, seed=None):
+    """Keep each item independently with probability ``fraction``."""
+    rng = random.Random(seed)
+    return [line for line in lines if rng.random() < fraction]
+
+
+def sample_lines(path, sample_size=None, fraction=None, seed=None):
+    """Return the header and a random sample of the raw data lines of ``path``.
+
+    Exactly one of ``sample_size`` (reservoir sampling) or ``fraction``
+    (Bernoulli sampling) must be given.  The file is read in a single
+    streaming pass and the total row count does not need to be known.
+    """
+    if (sample_size is None) == (fraction is None):
+        raise ValueError('pass exactly one of sample_size or fraction')
+    with _open(path) as f:
+        header = f.readline()
+        if sample_size is not None:
+            lines = reservoir_sample(f, sample_size, seed=seed)
+        else:
+            lines = bernoulli_sample(f, fraction, seed=seed)
+    return header, lines
+
+
+@instrumented('load', rows=len)
+def load_sample(path, sample_size=None, fraction=None, seed=None, **kwargs):
+    """Read a random sample of rows from a clickstream csv into a DataFrame.
+
+    Extra keyword arguments are passed through to ``pd.read_csv``.
+    """
+    header, lines = sample_lines(path, sample_size=sample_size,
+                                 fraction=fraction, seed=seed)
+    buf = io.BytesIO(header + b''.join(lines))
+    del lines
+    return pd.read_csv(buf, **kwargs)
+
+
+def load_train(path='train.gz', sample_size=None, seed=None):
+    """The notebook's training sample: compact dtypes plus time features.
+
+    String columns are read as categoricals, integers narrowed to the
+    smallest width and the ``YYMMDDHH`` hour decoded into ``hour``,
+    ``hour_of_day`` and ``day_of_week``.
+    """
+    df = load_sample(path, sample_size=sample_size, seed=seed,
+                     dtype=compact_types(types_train))
+    return add_time_features(narrow_ints(df))
+
+
+def read_batches(path, batch_size=100000):
+    """Yield ``(header, data)`` pairs of raw csv bytes, ``batch_size`` rows each."""
+    with _open(path) as f:
+        header = f.readline()
+        while True:
+            lines = list(itertools.islice(f, batch_size))
+            if not lines:
+                break
+            yield header, b''.join(lines)
+
+
+def parse_batch(header, data, dtype=None, transform=None):
+    """Parse one raw batch produced by ``read_batches`` into a DataFrame."""
+    df = pd.read_csv(io.BytesIO(header + data), dtype=dtype)
+    if transform is not None:
+        df = transform(df)
+    return df
+
+
+def bounded_map(fn, args, workers=None, max_pending=None, initializer=None,
+                initargs=()):
+    """Ordered ``map`` of ``fn(*a)`` over a process pool.
+
+    At most ``max_pending`` tasks (default twice the number of workers) are
+    in flight at once, so a slow consumer keeps memory bounded instead of
+    letting the whole input queue up in the pool.  With ``workers=1`` the
+    calls run inline in the current process.  ``initializer(*initargs)`` is
+    called once in every worker before it runs any task.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for a in args:
+            yield fn(*a)
+        return
+    max_pending = max_pending or 2 * workers
+    with ProcessPoolExecutor(workers, initializer=initializer,
+                             initargs=initargs) as pool:
+        pending = collections.deque()
+        for a in args:
+            pending.append(pool.submit(fn, *a))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_batches(path, dtype=None, batch_size=100000, workers=None,
+                 transform=None):
+    """Stream a clickstream csv as an iterator of DataFrames.
+
+    Decompression happens in the calling process; parsing with ``dtype``
+    (e.g. ``types_train`` or ``types_test``) and the optional ``transform``
+    run on a pool of ``workers`` processes.  ``transform`` must be picklable,
+    i.e. a module-level function.  Batches are yielded in file order.
+    """
+    parse = functools.partial(parse_batch, dtype=dtype, transform=transform)
+    return bounded_map(parse, read_batches(path, batch_size), workers=workers)
+
+
+def concat_batches(batches):
+    """Concatenate DataFrame batches, merging categorical vocabularies.
+
+    ``pd.concat`` falls back to object columns when the categories of the
+    batches differ; here categorical columns are combined with
+    ``union_categoricals`` so the result keeps one shared vocabulary.
+    """
+    batches = list(batches)
+    if not batches:
+        return pd.DataFrame()
+    categorical = [name for name, dtype in batches[0].dtypes.items()
+                   if isinstance(dtype, pd.CategoricalDtype)]
+    df = pd.concat([b.drop(columns=categorical) for b in batches],
+                   ignore_index=True)
+    for name in categorical:
+        df[name] = union_categoricals([b[name] for b in batches])
+    return df[batches[0].columns]
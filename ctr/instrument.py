@@ -0,0 +1,238 @@
+"""Stage timings, memory and sampling profiles of pipeline runs.
+
+Wrap a step in ``stage`` or decorate it with ``instrumented`` to record its
+wall and CPU time, rows processed and RSS in the process-wide ``recorder``;
+``export`` writes the totals as a Prometheus text file (for the node
+exporter's textfile collector) or as JSON.  ``Sampler`` takes a
+statistical profile of all threads in collapsed-stack format, which
+flamegraph tools read directly.
+
+Two environment variables turn both on for a whole run without code
+changes: ``CTR_METRICS=<path>`` exports the stages when the process exits
+and ``CTR_PROFILE=<path>`` samples the process from import to exit.
+"""
+
+import atexit
+import collections
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from ctr.resources import current_rss, peak_rss, reset_peak_rss
+
+
+class Recorder(object):
+    """Totals of every stage run so far, by stage name."""
+
+    def __init__(self):
+        self.totals = collections.OrderedDict()
+        self.last = {}
+        self._stack = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        """Record one run of stage ``name``.
+
+        Yields the record, whose ``rows`` may be set inside the block when
+        the count is only known at the end.  Stages may be nested; the
+        peak RSS of the outer stage includes the peaks of the inner ones.
+        """
+        record = {'stage': name, 'rows': rows, 'rss_start_mb': current_rss()}
+        if self._stack:
+            # keep the outer stage's peak so far before the counter is reset
+            outer = self._stack[-1]
+            outer['_inner_peak'] = max(outer.get('_inner_peak', 0), peak_rss())
+        reset_peak_rss()
+        self._stack.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            record['rss_end_mb'] = current_rss()
+            record['rss_delta_mb'] = record['rss_end_mb'] - record['rss_start_mb']
+            record['peak_rss_mb'] = max(peak_rss(), record.pop('_inner_peak', 0))
+            self._stack.pop()
+            if self._stack:
+                outer = self._stack[-1]
+                outer['_inner_peak'] = max(outer.get('_inner_peak', 0),
+                                           record['peak_rss_mb'])
+            self._add(record)
+
+    def _add(self, record):
+        with self._lock:
+            total = self.totals.setdefault(record['stage'], {
+                'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'rows': 0,
+                'rss_delta_mb': 0.0, 'peak_rss_mb': 0.0})
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            total['cpu_seconds'] += record['cpu_seconds']
+            total['rows'] += record['rows'] or 0
+            total['rss_delta_mb'] += record['rss_delta_mb']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+            self.last[record['stage']] = record
+
+    def report(self):
+        """Stage totals with throughput, in the order stages first ran."""
+        out = collections.OrderedDict()
+        for name, total in self.totals.items():
+            total = dict(total)
+            total['rows_per_second'] = (total['rows'] / total['seconds']
+                                        if total['rows'] and total['seconds'] else None)
+            out[name] = total
+        return out
+
+    def reset(self):
+        with self._lock:
+            self.totals.clear()
+            self.last.clear()
+
+
+recorder = Recorder()
+
+
+@contextlib.contextmanager
+def stage(name, rows=None, profile=None):
+    """``recorder.stage``: record a block as one run of stage ``name``.
+
+    With ``profile`` set to a path the block is also sampled by a
+    ``Sampler`` and the collapsed stacks are written there.
+    """
+    with recorder.stage(name, rows) as record:
+        if profile is None:
+            yield record
+        else:
+            with Sampler() as sampler:
+                yield record
+            sampler.write(profile)
+
+
+def instrumented(name=None, rows=None):
+    """Decorator recording each call as a run of stage ``name``.
+
+    ``rows`` is called with the function's return value and gives the
+    number of rows it processed, e.g. ``len``.
+    """
+    def decorate(fn):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with recorder.stage(stage_name) as record:
+                result = fn(*args, **kwargs)
+                if rows is not None:
+                    record['rows'] = rows(result)
+                return result
+        return wrapper
+    return decorate
+
+
+def prometheus_text(report, prefix='ctr_stage'):
+    """Stage totals in the Prometheus text exposition format."""
+    metrics = [
+        ('calls', 'calls_total', 'counter', 'Number of runs of the stage.'),
+        ('seconds', 'seconds_total', 'counter', 'Wall time spent in the stage.'),
+        ('cpu_seconds', 'cpu_seconds_total', 'counter', 'CPU time of the process during the stage.'),
+        ('rows', 'rows_total', 'counter', 'Rows processed by the stage.'),
+        ('rss_delta_mb', 'rss_delta_megabytes', 'gauge', 'Change of resident memory over the stage.'),
+        ('peak_rss_mb', 'peak_rss_megabytes', 'gauge', 'Peak resident memory during the stage.'),
+    ]
+    lines = []
+    for key, metric, kind, help_text in metrics:
+        metric = '%s_%s' % (prefix, metric)
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for name, total in report.items():
+            lines.append('%s{stage="%s"} %r' % (metric, name.replace('"', '\\"'),
+                                                float(total[key])))
+    return '\n'.join(lines) + '\n'
+
+
+def export(path, report=None):
+    """Write stage totals to ``path``: Prometheus text for ``.prom``, else JSON.
+
+    The file is replaced atomically so a collector never reads half of it.
+    """
+    report = recorder.report() if report is None else report
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        if path.endswith('.prom'):
+            f.write(prometheus_text(report))
+        else:
+            json.dump(report, f, indent=2)
+    os.replace(tmp, path)
+
+
+class Sampler(object):
+    """Statistical profiler sampling the stacks of all threads.
+
+    Every ``interval`` seconds a background thread records the call stack
+    of each other thread; ``write`` saves the counts as collapsed stacks
+    (``frame;frame;frame count`` per line).  Usable as a context manager.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name,
+                                                 os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ctr-sampler',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def top(self, n=20):
+        """The ``n`` functions most often on top of a sampled stack."""
+        leaves = collections.Counter()
+        for stack, count in self.counts.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(n)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+
+if os.environ.get('CTR_METRICS'):
+    atexit.register(export, os.environ['CTR_METRICS'])
+if os.environ.get('CTR_PROFILE'):
+    _sampler = Sampler().start()
+    atexit.register(lambda: _sampler.stop().write(os.environ['CTR_PROFILE']))
@@ -0,0 +1,91 @@
+"""One feature matrix shared by the LightGBM and XGBoost trainers."""
+
+import json
+import warnings
+
+import numpy as np
+
+from ctr import split
+
+
+class FeatureMatrix(object):
+    """Model features laid out once in a contiguous 2-D array.
+
+    ``data`` holds one column per name in ``features``; ``categorical``
+    lists the features the trainers should treat as categorical.  The
+    LightGBM and XGBoost inputs built from it reference ``data`` (or views
+    of it) instead of each converting a DataFrame again.
+    """
+
+    def __init__(self, data, features, categorical=()):
+        self.data = data
+        self.features = list(features)
+        self.categorical = [c for c in categorical if c in self.features]
+
+    @classmethod
+    def from_frame(cls, df, features, categorical=(), dtype=np.float32, order='C'):
+        """Copy ``features`` of ``df`` into a new array, one column at a time.
+
+        float32 holds every integer code below 2**24 exactly, which covers
+        the hashed columns at the default bucket count.
+        """
+        data = np.empty((len(df), len(features)), dtype=dtype, order=order)
+        for j, name in enumerate(features):
+            data[:, j] = df[name].values
+        return cls(data, features, categorical)
+
+    def save(self, path):
+        """Write the matrix to ``path.npy`` and its metadata to ``path.json``."""
+        np.save(path + '.npy', self.data)
+        with open(path + '.json', 'w') as f:
+            json.dump({'features': self.features, 'categorical': self.categorical}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Memory-map a matrix written by ``save``.
+
+        Processes that load the same file share its pages instead of each
+        holding a copy.
+        """
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        data = np.load(path + '.npy', mmap_mode=mmap_mode)
+        return cls(data, meta['features'], meta['categorical'])
+
+    def __len__(self):
+        return len(self.data)
+
+    def columns(self, features):
+        """The matrix restricted to ``features``.
+
+        No copy is made if ``features`` are a run of adjacent columns in
+        matrix order, e.g. all of them; any other selection copies the
+        selected columns, with a warning.
+        """
+        features = list(features)
+        if features == self.features:
+            return self
+        index = [self.features.index(name) for name in features]
+        if index == list(range(index[0], index[0] + len(index))):
+            data = self.data[:, index[0]:index[0] + len(index)]
+        else:
+            warnings.warn('selecting %d of %d columns out of matrix order copies %.0f MB; '
+                          'list them in the order of FeatureMatrix.features to avoid it'
+                          % (len(index), len(self.features),
+                             len(self) * len(index) * self.data.itemsize / 2 ** 20),
+                          RuntimeWarning, stacklevel=2)
+            data = self.data[:, index]
+        return FeatureMatrix(data, features, self.categorical)
+
+    def lgb_datasets(self, label, train, valid, params=None):
+        """LightGBM training and validation sets for rows ``train`` / ``valid``."""
+        return split.lgb_datasets(self.data, label, train, valid, params=params,
+                                  feature_name=self.features,
+                                  categorical_feature=self.categorical or 'auto')
+
+    def xgb_dmatrices(self, label, train, valid):
+        """XGBoost training and validation matrices for rows ``train`` / ``valid``."""
+        types = ['c' if name in self.categorical else 'q' for name in self.features]
+        return split.xgb_dmatrices(self.data, label, train, valid,
+                                   feature_names=self.features, feature_types=types,
+                                   enable_categorical=bool(self.categorical))
@@ -0,0 +1,140 @@
+"""Batch scoring of the test file with a trained booster."""
+
+import gzip
+import sys
+import time
+
+from ctr.crosses import crosses_in
+from ctr.ingest import bounded_map, parse_batch, read_batches
+from ctr.features import encode_frame
+from ctr.instrument import stage
+from ctr.schema import compact_types, narrow_ints, types_test
+from ctr.target_encoding import encoded_in
+
+_model = None
+_features = None
+_hasher = None
+_encoder = None
+_num_threads = 1
+
+
+def load_model(model_file):
+    """A LightGBM model file, a ``TreeEnsemble`` saved as ``.npz`` or a bundle.
+
+    Returns ``(model, feature_names)``.  Loading an ``.npz`` ensemble or a
+    ``ModelBundle`` does not import LightGBM, which keeps scoring processes
+    quick to start.
+    """
+    from ctr.bundle import ModelBundle, is_bundle
+
+    if is_bundle(model_file):
+        bundle = ModelBundle.load(model_file)
+        return bundle.model, bundle.features
+    if model_file.endswith('.npz'):
+        from ctr.trees import TreeEnsemble
+
+        model = TreeEnsemble.load(model_file)
+        return model, model.feature_names
+    import lightgbm as lgb
+
+    model = lgb.Booster(model_file=model_file)
+    return model, model.feature_name()
+
+
+def model_features(model_file):
+    """Feature names of a saved model, read without loading LightGBM."""
+    from ctr.bundle import is_bundle
+
+    if is_bundle(model_file) or model_file.endswith('.npz'):
+        return load_model(model_file)[1]
+    with open(model_file) as f:
+        for line in f:
+            if line.startswith('feature_names='):
+                return line.rstrip('\n').split('=', 1)[1].split(' ')
+    raise ValueError('%s has no feature_names line' % model_file)
+
+
+def check_encoder(features, encoder, model_file='the model'):
+    """Raise ``ValueError`` if ``features`` need target encoding tables but ``encoder`` is None."""
+    needed = encoded_in(features)
+    if needed and encoder is None:
+        raise ValueError('%s was trained on the target encoding features %s; '
+                         'pass the tables saved by features --encoder (--encoder <tables>)'
+                         % (model_file, ', '.join(needed)))
+
+
+def _init_worker(model_file, hasher, num_threads, encoder=None):
+    global _model, _features, _hasher, _encoder, _num_threads
+    from ctr.bundle import ModelBundle, is_bundle
+
+    _num_threads = num_threads
+    if is_bundle(model_file):
+        # the bundle carries its own hasher and encoder tables, mapped
+        # rather than read, so every worker shares the same pages
+        bundle = ModelBundle.load(model_file)
+        bundle.check_schema()
+        _model, _features = bundle.model, bundle.features
+        _hasher, _encoder = bundle.hasher, bundle.encoder
+    else:
+        _model, _features = load_model(model_file)
+        _hasher = hasher
+        _encoder = None
+        if encoder is not None:
+            from ctr.target_encoding import TargetEncoder
+
+            # memory-mapped, so all workers share one copy of the tables
+            _encoder = TargetEncoder.load(encoder)
+    check_encoder(_features, _encoder, model_file)
+
+
+def _score_batch(header, data):
+    df = narrow_ints(parse_batch(header, data, dtype=compact_types(types_test)))
+    ids = df['id'].values
+    X = encode_frame(df, _hasher, encoder=_encoder, crosses=crosses_in(_features))
+    if hasattr(_model, 'feature_name'):
+        return ids, _model.predict(X[_features], num_threads=_num_threads)
+    return ids, _model.predict(X[_features])
+
+
+def predict_file(model_file, hasher=None, src='test.gz', out='submission.csv',
+                 batch_size=100000, workers=None, num_threads=1, encoder=None,
+                 log=sys.stderr):
+    """Write ``id,click`` probabilities for every row of ``src`` to ``out``.
+
+    ``src`` is streamed in batches of ``batch_size`` rows, each of which is
+    parsed, encoded with ``hasher`` (the one used for training) and scored
+    by the model in ``model_file`` (see ``load_model``) on a pool of ``workers``
+    processes, each using ``num_threads`` threads.  ``encoder`` is the
+    directory of a saved ``TargetEncoder`` whose features the model was
+    trained with.  A ``ModelBundle`` brings its own hasher and encoder, and
+    ``hasher`` and ``encoder`` are then ignored.  Memory use does not
+    depend on the size of ``src``.  Returns a dict with the row count and
+    throughput.
+    """
+    from ctr.bundle import ModelBundle, is_bundle
+
+    # checked here as well as in the workers, so a missing encoder fails
+    # before any batch is read rather than as a broken process pool
+    if is_bundle(model_file):
+        bundle = ModelBundle.load(model_file)
+        check_encoder(bundle.features, bundle.encoder, model_file)
+    else:
+        check_encoder(model_features(model_file), encoder, model_file)
+    with stage('predict') as record:
+        start = time.time()
+        rows = 0
+        opener = gzip.open if out.endswith('.gz') else open
+        with opener(out, 'wt') as f:
+            f.write('id,click\n')
+            scores = bounded_map(_score_batch, read_batches(src, batch_size),
+                                 workers=workers, initializer=_init_worker,
+                                 initargs=(model_file, hasher, num_threads, encoder))
+            for ids, p in scores:
+                f.writelines('%d,%.6f\n' % row for row in zip(ids.tolist(), p.tolist()))
+                rows += len(ids)
+                if log is not None:
+                    log.write('scored {} rows, {:.0f} rows/s\n'.format(
+                        rows, rows / (time.time() - start)))
+        record['rows'] = rows
+    seconds = time.time() - start
+    return {'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds}
@@ -0,0 +1,65 @@
+"""Process memory measurements."""
+
+import contextlib
+import os
+import resource
+import sys
+
+
+def _status_kb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def current_rss():
+    """Resident set size of this process in MB."""
+    kb = _status_kb('VmRSS')
+    if kb is not None:
+        return kb / 1024.0
+    return peak_rss()
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB.
+
+    Since the last ``reset_peak_rss`` where the platform supports it,
+    otherwise over the lifetime of the process.
+    """
+    kb = _status_kb('VmHWM')
+    if kb is not None:
+        return kb / 1024.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (2.0 ** 20 if sys.platform == 'darwin' else 1024.0)
+
+
+def reset_peak_rss():
+    """Reset the peak RSS counter to the current RSS (Linux only)."""
+    try:
+        with open('/proc/%d/clear_refs' % os.getpid(), 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+@contextlib.contextmanager
+def measure_rss():
+    """Record RSS before and after the block and its peak, in MB.
+
+    Yields a dict that is filled with ``start``, ``end`` and ``peak`` when
+    the block exits.
+    """
+    usage = {'start': current_rss()}
+    reset_peak_rss()
+    try:
+        yield usage
+    finally:
+        usage['end'] = current_rss()
+        usage['peak'] = peak_rss()
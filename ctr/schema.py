@@ -0,0 +1,116 @@
+"""Column types of the Avazu train and test files."""
+
+import numpy as np
+
+types_train = {
+    'id': np.dtype(int),
+    'click': np.dtype(int),
+    'hour': np.dtype(int),
+    'C1': np.dtype(int),
+    'banner_pos': np.dtype(int),
+    'site_id': np.dtype(str),
+    'site_domain': np.dtype(str), 
+    'site_category': np.dtype(str),
+    'app_id': np.dtype(str),
+    'app_domain': np.dtype(str),
+    'app_category': np.dtype(str),
+    'device_id': np.dtype(str),
+    'device_ip': np.dtype(str),
+    'device_model': np.dtype(str),
+    'device_type': np.dtype(int),
+    'device_conn_type': np.dtype(int),
+    'C14': np.dtype(int),
+    'C15': np.dtype(int),
+    'C16': np.dtype(int),
+    'C17': np.dtype(int),
+    'C18': np.dtype(int),
+    'C19': np.dtype(int),
+    'C20': np.dtype(int),
+    'C21':np.dtype(int)
+}
+
+types_test = {
+    'id': np.dtype(int),
+    'hour': np.dtype(int),
+    'C1': np.dtype(int),
+    'banner_pos': np.dtype(int),
+    'site_id': np.dtype(str),
+    'site_domain': np.dtype(str), 
+    'site_category': np.dtype(str),
+    'app_id': np.dtype(str),
+    'app_domain': np.dtype(str),
+    'app_category': np.dtype(str),
+    'device_id': np.dtype(str),
+    'device_ip': np.dtype(str),
+    'device_model': np.dtype(str),
+    'device_type': np.dtype(int),
+    'device_conn_type': np.dtype(int),
+    'C14': np.dtype(int),
+    'C15': np.dtype(int),
+    'C16': np.dtype(int),
+    'C17': np.dtype(int),
+    'C18': np.dtype(int),
+    'C19': np.dtype(int),
+    'C20': np.dtype(int),
+    'C21':np.dtype(int)
+}
+
+# narrowest integer type holding every value of the column in the Avazu data
+int_widths = {
+    'id': np.dtype(np.uint64),
+    'click': np.dtype(np.int8),
+    'hour': np.dtype(np.int32),
+    'C1': np.dtype(np.int16),
+    'banner_pos': np.dtype(np.int8),
+    'device_type': np.dtype(np.int8),
+    'device_conn_type': np.dtype(np.int8),
+    'C14': np.dtype(np.int16),
+    'C15': np.dtype(np.int16),
+    'C16': np.dtype(np.int16),
+    'C17': np.dtype(np.int16),
+    'C18': np.dtype(np.int8),
+    'C19': np.dtype(np.int16),
+    'C20': np.dtype(np.int32),
+    'C21': np.dtype(np.int16),
+}
+
+
+def compact_types(types):
+    """Parse types that read string columns as dictionary-encoded categoricals.
+
+    Integer columns are parsed as int32 (``id`` as uint64) and narrowed
+    afterwards by ``narrow_ints``, because ``pd.read_csv`` silently wraps
+    values that overflow a narrower type.
+    """
+    compact = {}
+    for name, dtype in types.items():
+        if dtype.kind == 'U':
+            compact[name] = 'category'
+        elif int_widths.get(name, dtype).itemsize == 8:
+            compact[name] = int_widths.get(name, dtype)
+        else:
+            compact[name] = np.dtype(np.int32)
+    return compact
+
+
+def narrow_ints(df):
+    """Downcast the integer columns of ``df`` in place to ``int_widths``."""
+    for name, dtype in int_widths.items():
+        if name not in df or df[name].dtype == dtype:
+            continue
+        values = df[name].values
+        info = np.iinfo(dtype)
+        if len(values) and (values.min() < info.min or values.max() > info.max):
+            raise OverflowError('column {} has values outside {}'.format(name, dtype))
+        df[name] = values.astype(dtype)
+    return df
+
+
+def memory_report(**frames):
+    """Deep memory usage in MB per column of each keyword-named frame."""
+    import pandas as pd
+
+    report = pd.DataFrame({name: df.memory_usage(index=False, deep=True) / 2**20
+                           for name, df in frames.items()})
+    report.loc['total'] = report.sum()
+    return report
@@ -0,0 +1,209 @@
+"""Parallel hyperparameter search with successive halving.
+
+Trials run concurrently on a process pool.  Every worker memory-maps the
+same saved ``FeatureMatrix``, so the raw features are held in memory once
+however many trials are running, and the machine's threads are divided
+evenly between the workers.
+
+Bad trials are stopped early with asynchronous successive halving: at
+rungs of ``min_rounds * eta**k`` boosting rounds each trial records its
+validation logloss, and carries on only if it is among the best
+``1 / eta`` of the trials that have reached that rung so far.
+"""
+
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from ctr.ingest import bounded_map
+from ctr.matrix import FeatureMatrix
+from ctr.train import LGB_PARAMS, XGB_PARAMS, json_params
+
+# a list is sampled as a choice, a (low, high) tuple uniformly
+LGB_SPACE = {
+    'num_leaves': [15, 31, 63, 127, 255],
+    'learning_rate': [0.02, 0.04, 0.08, 0.16],
+    'feature_fraction': (0.5, 1.0),
+    'bagging_fraction': (0.3, 1.0),
+    'min_data_in_leaf': [20, 100, 500, 2000],
+    'lambda_l2': [0.0, 1.0, 10.0],
+}
+XGB_SPACE = {
+    'eta': [0.025, 0.05, 0.1, 0.2],
+    'max_depth': [3, 4, 5, 6, 8, 10],
+    'subsample': (0.5, 1.0),
+    'colsample_bytree': (0.5, 1.0),
+    'min_child_weight': [1, 10, 100],
+    'lambda': [0.0, 1.0, 10.0],
+}
+
+
+def sample_params(space, n, seed=0):
+    """``n`` random configurations drawn from ``space``."""
+    rng = np.random.RandomState(seed)
+    trials = []
+    for _ in range(n):
+        params = {}
+        for name in sorted(space):
+            values = space[name]
+            if isinstance(values, tuple):
+                params[name] = float(rng.uniform(*values))
+            else:
+                params[name] = values[rng.randint(len(values))]
+        trials.append(params)
+    return trials
+
+
+class Rungs(object):
+    """Validation losses reached by all trials at each rung, shared across processes."""
+
+    def __init__(self, records, lock, min_rounds, eta):
+        self.records = records
+        self.lock = lock
+        self.min_rounds = min_rounds
+        self.eta = eta
+
+    def is_rung(self, rounds):
+        r = self.min_rounds
+        while r < rounds:
+            r *= self.eta
+        return r == rounds
+
+    def promote(self, rounds, loss):
+        """Record ``loss`` at ``rounds`` and tell whether the trial should go on."""
+        with self.lock:
+            losses = self.records.get(rounds, []) + [loss]
+            self.records[rounds] = losses
+        keep = len(losses) // self.eta
+        if len(losses) < self.eta:
+            return True
+        return loss <= sorted(losses)[keep - 1]
+
+
+# per-process state set up by _init_worker
+_fm = None
+_label = None
+_split = None
+_rungs = None
+_num_threads = 1
+_datasets = None
+
+
+def _init_worker(path, split, rungs, num_threads):
+    global _fm, _label, _split, _rungs, _num_threads, _datasets
+    _fm = FeatureMatrix.load(path)
+    _label = np.load(path + '.label.npy', mmap_mode='r')
+    _split = split
+    _rungs = rungs
+    _num_threads = num_threads
+    _datasets = None
+
+
+def _run_lightgbm(params, max_rounds):
+    import lightgbm as lgb
+    global _datasets
+
+    if _datasets is None:
+        # binned once per worker; the search space only holds booster params
+        train_set, valid_set = _fm.lgb_datasets(np.asarray(_label), *_split,
+                                                params={'verbose': -1})
+        _datasets = (train_set.construct(), valid_set.construct())
+    train_set, valid_set = _datasets
+    curve = []
+
+    def halving(env):
+        loss = env.evaluation_result_list[0][2]
+        curve.append(loss)
+        rounds = env.iteration + 1
+        if _rungs.is_rung(rounds) and not _rungs.promote(rounds, loss):
+            raise lgb.callback.EarlyStopException(env.iteration,
+                                                  env.evaluation_result_list)
+
+    params = dict(params, num_threads=_num_threads)
+    lgb.train(params, train_set, num_boost_round=max_rounds,
+              valid_sets=[valid_set], callbacks=[halving])
+    return curve
+
+
+def _run_xgboost(params, max_rounds):
+    import xgboost as xgb
+    global _datasets
+
+    if _datasets is None:
+        _datasets = _fm.xgb_dmatrices(np.asarray(_label), *_split)
+    dtrain, dvalid = _datasets
+    curve = []
+
+    class Halving(xgb.callback.TrainingCallback):
+        def after_iteration(self, model, epoch, evals_log):
+            loss = list(evals_log['eval'].values())[0][-1]
+            curve.append(loss)
+            rounds = epoch + 1
+            return _rungs.is_rung(rounds) and not _rungs.promote(rounds, loss)
+
+    params = dict(params, nthread=_num_threads)
+    xgb.train(params, dtrain, max_rounds, evals=[(dvalid, 'eval')],
+              verbose_eval=False, callbacks=[Halving()])
+    return curve
+
+
+def _run_trial(engine, trial, params, max_rounds):
+    run = _run_lightgbm if engine == 'lightgbm' else _run_xgboost
+    curve = [float(x) for x in run(params, max_rounds)]
+    best = int(np.argmin(curve))
+    return {'trial': trial, 'params': params, 'rounds': len(curve),
+            'best_iteration': best + 1, 'logloss': curve[best], 'curve': curve}
+
+
+def search(fm, label, train, valid, engine='lightgbm', base_params=None,
+           space=None, n_trials=27, min_rounds=27, max_rounds=729, eta=3,
+           workers=None, threads=None, out_dir='search', seed=0):
+    """Search ``space`` around ``base_params`` and return the best trial.
+
+    ``fm`` and ``label`` are saved under ``out_dir`` and memory-mapped by
+    every worker; ``train`` and ``valid`` select rows as for
+    ``FeatureMatrix.lgb_datasets``.  ``engine`` is ``'lightgbm'`` or
+    ``'xgboost'``.  ``threads`` (default all cores) are divided between
+    ``workers`` trials running at once.  Writes ``best.json`` with the best
+    configuration and ``curves.json`` with every trial's validation
+    logloss per round.
+    """
+    if engine == 'lightgbm':
+        base_params = LGB_PARAMS if base_params is None else base_params
+        space = LGB_SPACE if space is None else space
+    elif engine == 'xgboost':
+        base_params = XGB_PARAMS if base_params is None else base_params
+        space = XGB_SPACE if space is None else space
+    else:
+        raise ValueError('unknown engine %r' % engine)
+    threads = threads or os.cpu_count() or 1
+    workers = min(workers or threads, n_trials)
+    num_threads = max(1, threads // workers)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    path = os.path.join(out_dir, 'matrix')
+    fm.save(path)
+    np.save(path + '.label.npy', np.asarray(label, dtype=np.float32))
+
+    # JSON-safe up front, so that curves.json and best.json can be written
+    configs = [json_params(dict(base_params, **p))
+               for p in sample_params(space, n_trials, seed)]
+    with multiprocessing.Manager() as manager:
+        rungs = Rungs(manager.dict(), manager.Lock(), min_rounds, eta)
+        tasks = ((engine, i, p, max_rounds) for i, p in enumerate(configs))
+        trials = list(bounded_map(_run_trial, tasks, workers=workers,
+                                  initializer=_init_worker,
+                                  initargs=(path, (train, valid), rungs, num_threads)))
+
+    best = min(trials, key=lambda t: t['logloss'])
+    with open(os.path.join(out_dir, 'curves.json'), 'w') as f:
+        json.dump(trials, f)
+    with open(os.path.join(out_dir, 'best.json'), 'w') as f:
+        json.dump({k: best[k] for k in ('trial', 'params', 'best_iteration', 'logloss')},
+                  f, indent=2)
+    for name in ('matrix.npy', 'matrix.json', 'matrix.label.npy'):
+        os.remove(os.path.join(out_dir, name))
+    return best
@@ -0,0 +1,327 @@
+"""Online CTR scoring over HTTP with request micro-batching.
+
+Run with ``python -m ctr.serve --model gbm.txt --hasher hasher.json``.
+``POST /predict`` takes one impression record (or a list of them) with the
+``types_test`` columns and returns ``{"click": [...]}``; ``GET /metrics``
+returns latency percentiles and throughput.  Concurrent requests are
+collected for at most ``max_wait`` seconds (or ``max_batch`` records) and
+scored with a single ``predict`` call.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import time
+
+import numpy as np
+
+from ctr.crosses import crosses_in
+from ctr.features import encode_frame
+from ctr.hashing import FeatureHasher
+from ctr.schema import int_widths, narrow_ints, types_test
+from ctr.trees import TreeEnsemble
+
+
+class Scorer(object):
+    """Turns raw impression records into click probabilities.
+
+    ``model`` is a LightGBM booster or a ``TreeEnsemble``; with
+    ``compiled=True`` a booster is exported to a ``TreeEnsemble`` first.
+    """
+
+    def __init__(self, model, hasher, compiled=False, encoder=None):
+        if compiled and not isinstance(model, TreeEnsemble):
+            model = TreeEnsemble.from_lightgbm(model)
+        self.model = model
+        self.hasher = hasher
+        self.encoder = encoder
+        if isinstance(model, TreeEnsemble):
+            self.features = model.feature_names
+        else:
+            self.features = model.feature_name()
+
+    @classmethod
+    def load(cls, model_file, hasher_file, compiled=False, encoder_dir=None):
+        """Scorer for saved model files; a bundle needs no ``hasher_file``."""
+        from ctr.bundle import ModelBundle, is_bundle
+        from ctr.predict import load_model
+
+        if is_bundle(model_file):
+            bundle = ModelBundle.load(model_file)
+            bundle.check_schema()
+            return cls(bundle.model, bundle.hasher, compiled, bundle.encoder)
+        with open(hasher_file) as f:
+            hasher = FeatureHasher.from_dict(json.load(f))
+        encoder = None
+        if encoder_dir is not None:
+            from ctr.target_encoding import TargetEncoder
+
+            encoder = TargetEncoder.load(encoder_dir)
+        return cls(load_model(model_file)[0], hasher, compiled, encoder)
+
+    def __call__(self, records):
+        import pandas as pd
+
+        df = pd.DataFrame.from_records(records, columns=list(types_test))
+        for name, dtype in types_test.items():
+            if dtype.kind != 'U':
+                # parsed wide, then narrowed with the batch path's range check,
+                # so an out-of-range value fails instead of wrapping around
+                width = int_widths.get(name, dtype)
+                df[name] = df[name].astype(width if width.itemsize == 8 else np.int64)
+        narrow_ints(df)
+        X = encode_frame(df, self.hasher, encoder=self.encoder,
+                         crosses=crosses_in(self.features))
+        return self.model.predict(X[self.features])
+
+
+class LatencyStats(object):
+    """Request latencies over a sliding window plus running totals."""
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.started = time.time()
+        self.requests = 0
+        self.records = 0
+        self.batches = 0
+
+    def record(self, seconds, records):
+        self.latencies.append(seconds)
+        self.requests += 1
+        self.records += records
+
+    def snapshot(self):
+        elapsed = time.time() - self.started
+        latencies = np.array(self.latencies) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (0.0, 0.0)
+        return {'requests': self.requests,
+                'records': self.records,
+                'batches': self.batches,
+                'mean_batch_records': self.records / max(self.batches, 1),
+                'p50_ms': float(p50),
+                'p99_ms': float(p99),
+                'requests_per_second': self.requests / elapsed,
+                'records_per_second': self.records / elapsed}
+
+
+class MicroBatcher(object):
+    """Collects records from concurrent callers into batches for ``score``.
+
+    ``score`` runs in a worker thread so new requests keep queueing while a
+    batch is being scored.  If a batch fails, each of its requests is
+    scored on its own, so only the requests that cause the error fail.
+    """
+
+    def __init__(self, score, max_batch=256, max_wait=0.002, stats=None):
+        self.score = score
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = stats or LatencyStats()
+        self.queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, records):
+        """Scores for ``records``, scored together with other pending requests."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((records, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            size = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                size += len(item[0])
+            records = [r for rs, _ in pending for r in rs]
+            try:
+                scores = await loop.run_in_executor(None, self.score, records)
+            except Exception as e:
+                if len(pending) == 1:
+                    if not pending[0][1].done():
+                        pending[0][1].set_exception(e)
+                else:
+                    await self._score_each(pending)
+                continue
+            self.stats.batches += 1
+            offset = 0
+            for rs, future in pending:
+                if not future.done():
+                    future.set_result(scores[offset:offset + len(rs)].tolist())
+                offset += len(rs)
+
+    async def _score_each(self, pending):
+        loop = asyncio.get_running_loop()
+        for records, future in pending:
+            try:
+                scores = await loop.run_in_executor(None, self.score, records)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            self.stats.batches += 1
+            if not future.done():
+                future.set_result(scores.tolist())
+
+
+async def _read_message(reader):
+    """Start line fields, headers and body of one HTTP/1.1 message.
+
+    Returns ``None`` when the peer closed the connection.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    start = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return start, headers, body
+
+
+def _response(status, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    head = ('HTTP/1.1 %s\r\nContent-Type: application/json\r\n'
+            'Content-Length: %d\r\nConnection: %s\r\n\r\n'
+            % (status, len(body), 'keep-alive' if keep_alive else 'close'))
+    return head.encode('latin-1') + body
+
+
+def make_handler(batcher):
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_message(reader)
+                except (asyncio.IncompleteReadError, ValueError):
+                    break
+                if request is None or len(request[0]) < 2:
+                    break
+                (method, path), headers, body = request[0][:2], request[1], request[2]
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                start = time.perf_counter()
+                if method == 'POST' and path == '/predict':
+                    try:
+                        records = json.loads(body)
+                        if isinstance(records, dict):
+                            records = [records]
+                        # malformed bodies are rejected before joining a batch
+                        if not isinstance(records, list) or not all(
+                                isinstance(r, dict) for r in records):
+                            raise ValueError('expected a JSON object or a list of objects')
+                        scores = await batcher.submit(records)
+                        batcher.stats.record(time.perf_counter() - start, len(records))
+                        response = _response('200 OK', {'click': scores}, keep_alive)
+                    except Exception as e:
+                        response = _response('400 Bad Request', {'error': str(e)}, keep_alive)
+                elif method == 'GET' and path == '/metrics':
+                    response = _response('200 OK', batcher.stats.snapshot(), keep_alive)
+                else:
+                    response = _response('404 Not Found', {'error': 'not found'}, keep_alive)
+                writer.write(response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+    return handle
+
+
+async def start_server(score, host='127.0.0.1', port=8080, max_batch=256,
+                       max_wait=0.002):
+    """Start serving ``score`` and return ``(server, batcher)``."""
+    batcher = MicroBatcher(score, max_batch=max_batch, max_wait=max_wait)
+    batcher.start()
+    server = await asyncio.start_server(make_handler(batcher), host, port)
+    return server, batcher
+
+
+class Client(object):
+    """Minimal keep-alive HTTP client for the scoring service."""
+
+    def __init__(self, host='127.0.0.1', port=8080):
+        self.host = host
+        self.port = port
+        self._reader = self._writer = None
+
+    async def request(self, method, path, payload=None):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        body = b'' if payload is None else json.dumps(payload).encode()
+        self._writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n\r\n'
+                            % (method, path, self.host, len(body))).encode('latin-1') + body)
+        await self._writer.drain()
+        response = await _read_message(self._reader)
+        if response is None:
+            raise ConnectionError('connection closed by server')
+        start, _, body = response
+        payload = json.loads(body)
+        if start[1] != '200':
+            raise RuntimeError(payload.get('error', 'request failed'))
+        return payload
+
+    async def predict(self, records):
+        return (await self.request('POST', '/predict', records))['click']
+
+    async def metrics(self):
+        return await self.request('GET', '/metrics')
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default='gbm.txt')
+    parser.add_argument('--hasher', default='hasher.json',
+                        help='ignored when --model is a bundle')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--compiled', action='store_true',
+                        help='score with the flattened tree ensemble')
+    parser.add_argument('--encoder', default=None,
+                        help='directory of the target encoder the model was trained with')
+    args = parser.parse_args(argv)
+
+    async def run():
+        scorer = Scorer.load(args.model, args.hasher, args.compiled, args.encoder)
+        server, _ = await start_server(scorer, args.host, args.port,
+                                       args.max_batch, args.max_wait_ms / 1000)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Fixed-memory sketches for high-cardinality fields.
+
+``HyperLogLog`` estimates distinct counts and ``HeavyHitters`` tracks the
+most frequent values together with their clicks.  Both are updated one
+batch at a time and can be merged, so a full pass over the data can be
+split across chunks, files or worker processes and combined afterwards.
+"""
+
+import numpy as np
+import pandas as pd
+
+from ctr.eda import count_clicks, factorize
+from ctr.hashing import hash_values
+
+
+class HyperLogLog(object):
+    """Distinct count estimate with ``2**p`` one-byte registers.
+
+    The relative standard error is about ``1.04 / sqrt(2**p)``, i.e. 0.8%
+    for the default ``p=14`` using 16 KB.
+    """
+
+    def __init__(self, p=14, seed=0):
+        if not 11 <= p <= 18:
+            # the bits below the register index must fit exactly in a float64
+            raise ValueError('p must be between 11 and 18')
+        self.p = p
+        self.seed = seed
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def add(self, values):
+        h = hash_values(values, self.seed)
+        bits = 64 - self.p
+        index = (h >> np.uint64(bits)).astype(np.intp)
+        rest = h & np.uint64((1 << bits) - 1)
+        # position of the leftmost 1-bit within the low `bits` bits
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        rank = (bits - bit_length + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        if (other.p, other.seed) != (self.p, self.seed):
+            raise ValueError('cannot merge sketches with different parameters')
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+
+class CountMinSketch(object):
+    """Impression and click counts per value in ``depth x width`` counters.
+
+    Estimates never undercount; they overcount by at most ``e / width`` of
+    the total with probability ``1 - exp(-depth)``.
+    """
+
+    def __init__(self, width=2**18, depth=4, seed=0):
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.impressions = np.zeros((depth, width), dtype=np.int64)
+        self.clicks = np.zeros((depth, width), dtype=np.int64)
+
+    def _buckets(self, values, row):
+        return (hash_values(values, self.seed + row) % np.uint64(self.width)).astype(np.intp)
+
+    def add(self, values, clicks):
+        clicks = np.asarray(clicks, dtype=np.float64)
+        for row in range(self.depth):
+            impressions, clicked = count_clicks(self._buckets(values, row),
+                                                clicks, self.width)
+            self.impressions[row] += impressions
+            self.clicks[row] += clicked
+        return self
+
+    def estimate(self, values):
+        """Estimated ``(impressions, clicks)`` arrays for ``values``."""
+        buckets = [self._buckets(values, row) for row in range(self.depth)]
+        impressions = np.min([self.impressions[row, b] for row, b in enumerate(buckets)], axis=0)
+        clicks = np.min([self.clicks[row, b] for row, b in enumerate(buckets)], axis=0)
+        return impressions, clicks
+
+    def merge(self, other):
+        if (other.width, other.depth, other.seed) != (self.width, self.depth, self.seed):
+            raise ValueError('cannot merge sketches with different parameters')
+        self.impressions += other.impressions
+        self.clicks += other.clicks
+        return self
+
+
+class HeavyHitters(object):
+    """Top-``k`` most frequent values of a field with their CTR.
+
+    Counts come from a ``CountMinSketch``; a bounded candidate set of
+    ``capacity`` values (the frequent values of each batch plus the current
+    leaders) decides which values are reported.
+    """
+
+    def __init__(self, k=10, capacity=None, width=2**18, depth=4, seed=0):
+        self.k = k
+        self.capacity = capacity or 50 * k
+        self.sketch = CountMinSketch(width, depth, seed)
+        self.candidates = None
+        self.total = 0
+
+    def _trim(self, candidates):
+        # candidates keep the dtype of the field, so integer fields are
+        # hashed as integers when estimated
+        if self.candidates is not None:
+            candidates = np.concatenate([self.candidates, candidates])
+        candidates = pd.unique(candidates)
+        impressions, _ = self.sketch.estimate(candidates)
+        keep = np.argsort(-impressions, kind='stable')[:self.capacity]
+        self.candidates = candidates[keep]
+
+    def add(self, values, clicks):
+        self.sketch.add(values, clicks)
+        self.total += len(values)
+        codes, uniques = factorize(values)
+        impressions = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        local = np.argsort(-impressions, kind='stable')[:self.capacity]
+        local = local[impressions[local] > 0]
+        self._trim(np.asarray(uniques[local]))
+        return self
+
+    def top(self, name='value'):
+        """Table of the top values with impressions, share, clicks and CTR."""
+        if self.candidates is None:
+            return pd.DataFrame(columns=[name, 'impressions', 'share', 'clicks', 'CTR'])
+        impressions, clicks = self.sketch.estimate(self.candidates)
+        order = np.argsort(-impressions, kind='stable')[:self.k]
+        table = pd.DataFrame({name: self.candidates[order],
+                              'impressions': impressions[order],
+                              'share': impressions[order] / max(self.total, 1),
+                              'clicks': clicks[order]})
+        table['CTR'] = table['clicks'] / table['impressions'] * 100
+        return table
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        self.total += other.total
+        if other.candidates is not None:
+            self._trim(other.candidates)
+        return self
+
+
+def sketch_batches(batches, fields, k=10, target='click', p=14):
+    """One streaming pass computing distinct counts and top-``k`` per field.
+
+    Returns ``{field: (HyperLogLog, HeavyHitters)}``; sketches computed over
+    separate streams can be combined with their ``merge`` methods.
+    """
+    sketches = dict((field, (HyperLogLog(p), HeavyHitters(k))) for field in fields)
+    for batch in batches:
+        clicks = batch[target].values
+        for field, (distinct, heavy) in sketches.items():
+            distinct.add(batch[field])
+            heavy.add(batch[field], clicks)
+    return sketches
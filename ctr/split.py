@@ -0,0 +1,74 @@
+"""Time-based train/validation splits over one shared feature matrix."""
+
+import numpy as np
+
+from ctr.features import hour_key
+
+
+def time_split(hours, valid_days=2, cutoff=None):
+    """Split rows into training and validation sets by time.
+
+    Rows from the last ``valid_days`` days (or from the hour ``cutoff``
+    on, given as ``YYMMDDHH`` or a timestamp) are used for validation and
+    all earlier rows for training, matching how the model is served.  When
+    the rows are ordered by time, as in ``train.gz``, both parts are
+    returned as slices, so ``X[train]`` and ``X[valid]`` are views of the
+    same array; otherwise they are index arrays.  Raises ``ValueError``
+    if either part would be empty.
+    """
+    keys = hour_key(hours)
+    if not len(keys):
+        raise ValueError('no rows to split')
+    if cutoff is None:
+        days = np.unique(keys // 100)
+        if not 0 < valid_days < len(days):
+            raise ValueError('valid_days must be between 1 and %d for rows spanning %d days, '
+                             'got %r' % (len(days) - 1, len(days), valid_days))
+        cutoff = days[len(days) - valid_days] * 100
+    elif not isinstance(cutoff, (int, np.integer)):
+        cutoff = hour_key([np.datetime64(cutoff)])[0]
+    is_valid = keys >= cutoff
+    if is_valid.all() or not is_valid.any():
+        raise ValueError('cutoff %d leaves no %s rows; the rows span hours %d to %d'
+                         % (cutoff, 'training' if is_valid.all() else 'validation',
+                            keys.min(), keys.max()))
+    first = int(np.argmax(is_valid)) if is_valid.any() else len(keys)
+    if is_valid[first:].all():
+        return slice(0, first), slice(first, len(keys))
+    return np.flatnonzero(~is_valid), np.flatnonzero(is_valid)
+
+
+def _rows(X, rows):
+    return X.iloc[rows] if hasattr(X, 'iloc') else X[rows]
+
+
+def lgb_datasets(X, y, train, valid, params=None, **kwargs):
+    """LightGBM training and validation ``Dataset`` for a split of ``X``.
+
+    Slices are passed on as views.  For index arrays the full matrix is
+    binned once and both sets are ``subset`` views of it, so the raw rows
+    are never copied.
+    """
+    import lightgbm as lgb
+
+    if isinstance(train, slice) and isinstance(valid, slice):
+        train_set = lgb.Dataset(_rows(X, train), y[train], params=params, **kwargs)
+        valid_set = lgb.Dataset(_rows(X, valid), y[valid], reference=train_set, **kwargs)
+        return train_set, valid_set
+    full = lgb.Dataset(X, y, params=params, free_raw_data=False, **kwargs).construct()
+    return full.subset(np.asarray(train)), full.subset(np.asarray(valid))
+
+
+def xgb_dmatrices(X, y, train, valid, **kwargs):
+    """XGBoost training and validation ``DMatrix`` for a split of ``X``.
+
+    Slices are passed on as views; for index arrays one ``DMatrix`` is
+    built for all rows and sliced.
+    """
+    import xgboost as xgb
+
+    if isinstance(train, slice) and isinstance(valid, slice):
+        return (xgb.DMatrix(_rows(X, train), y[train], **kwargs),
+                xgb.DMatrix(_rows(X, valid), y[valid], **kwargs))
+    full = xgb.DMatrix(X, y, **kwargs)
+    return full.slice(np.asarray(train)), full.slice(np.asarray(valid))
@@ -0,0 +1,120 @@
+"""Incremental click and impression counters partitioned by hour."""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from ctr.eda import count_clicks, factorize
+from ctr.features import hour_key
+
+
+def _as_key(value):
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    return int(hour_key([np.datetime64(value)])[0])
+
+
+class CTRStore(object):
+    """Persistent click and impression counts per feature value and hour.
+
+    Batches of raw or decoded records are absorbed with ``update``; every
+    hour touched is written back to ``<path>/<YYMMDDHH>.npz``, so the store
+    survives restarts and late data for an hour is simply added on.  CTR
+    queries over any window of hours combine the stored counters and never
+    look at the raw records again.
+    """
+
+    def __init__(self, path, features):
+        self.path = path
+        self.features = list(features)
+        self._partitions = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def hours(self):
+        """Sorted ``YYMMDDHH`` keys of all stored partitions."""
+        return sorted(int(name[:-4]) for name in os.listdir(self.path)
+                      if name.endswith('.npz'))
+
+    def _file(self, hour):
+        return os.path.join(self.path, '%d.npz' % hour)
+
+    def _load(self, hour):
+        if hour not in self._partitions:
+            partition = {}
+            if os.path.exists(self._file(hour)):
+                with np.load(self._file(hour)) as data:
+                    for feature in self.features:
+                        if feature + '.values' in data:
+                            partition[feature] = pd.DataFrame(
+                                {'impressions': data[feature + '.impressions'],
+                                 'clicks': data[feature + '.clicks']},
+                                index=data[feature + '.values'])
+            self._partitions[hour] = partition
+        return self._partitions[hour]
+
+    def _save(self, hour):
+        arrays = {}
+        for feature, counts in self._partitions[hour].items():
+            index = np.asarray(counts.index)
+            if index.dtype == object:
+                # stored as a fixed-width unicode array so no pickling is needed
+                index = index.astype(str)
+            arrays[feature + '.values'] = index
+            arrays[feature + '.impressions'] = counts['impressions'].values
+            arrays[feature + '.clicks'] = counts['clicks'].values
+        tmp = self._file(hour) + '.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self._file(hour))
+
+    def update(self, batch, target='click', hour='hour'):
+        """Add the impressions and clicks of the records in ``batch``."""
+        if len(batch) == 0:
+            return
+        hour_codes, hour_keys = pd.factorize(hour_key(batch[hour].values))
+        n_hours = len(hour_keys)
+        clicks = np.asarray(batch[target].values, dtype=np.float64)
+        for feature in self.features:
+            codes, uniques = factorize(batch[feature])
+            keep = codes >= 0
+            keys = hour_codes[keep].astype(np.int64) * len(uniques) + codes[keep]
+            # count only the (hour, value) pairs present: hours x values bins
+            # would be almost all zero for a column like device_ip
+            pairs, inverse = np.unique(keys, return_inverse=True)
+            impressions, clicked = count_clicks(inverse, clicks[keep], len(pairs))
+            pair_hours, values = np.divmod(pairs, len(uniques))
+            bounds = np.searchsorted(pair_hours, np.arange(n_hours + 1))
+            for h in range(n_hours):
+                part = slice(bounds[h], bounds[h + 1])
+                if part.start == part.stop:
+                    continue
+                counts = pd.DataFrame({'impressions': impressions[part],
+                                       'clicks': clicked[part]},
+                                      index=uniques[values[part]])
+                partition = self._load(int(hour_keys[h]))
+                if feature in partition:
+                    counts = partition[feature].add(counts, fill_value=0).astype(np.int64)
+                partition[feature] = counts
+        for key in hour_keys:
+            self._save(int(key))
+
+    def query(self, feature, start=None, end=None):
+        """Impressions, clicks and CTR (in percent) of ``feature`` between two hours.
+
+        ``start`` and ``end`` are inclusive and may be ``YYMMDDHH`` integers
+        or timestamps; ``None`` leaves that side of the window open.
+        """
+        hours = self.hours()
+        if start is not None:
+            hours = [h for h in hours if h >= _as_key(start)]
+        if end is not None:
+            hours = [h for h in hours if h <= _as_key(end)]
+        counts = [self._load(h)[feature] for h in hours if feature in self._load(h)]
+        if counts:
+            total = pd.concat(counts).groupby(level=0).sum()
+        else:
+            total = pd.DataFrame({'impressions': [], 'clicks': []}, dtype=np.int64)
+        table = total.rename_axis(feature).reset_index()
+        table['CTR'] = table['clicks'] / table['impressions'] * 100
+        return table
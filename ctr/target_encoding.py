@@ -0,0 +1,198 @@
+"""Smoothed click-rate and impression-count features for high-cardinality ids.
+
+For each encoded column a value's statistics are its impressions ``n`` and
+clicks ``c``; the features are ``n`` and the smoothed CTR
+``(c + m * prior) / (n + m)``, where ``prior`` is the overall CTR and ``m``
+is ``prior_weight``.  Values are identified by their 64-bit hash (seeded
+per column, as in ``FeatureHasher``), and the fitted tables are three
+arrays per column: sorted hashes, impressions and clicks.  Scoring looks
+every row up with one ``np.searchsorted`` per column.
+
+Computing the features of training rows from statistics that include their
+own label leaks it into the model, so training rows are encoded in one of
+three leak-free ways:
+
+* ``fit_transform(df, hours=...)`` uses only rows from strictly earlier
+  hours, which matches what is known when a row is scored;
+* ``fit_transform(df, folds=k)`` uses the rows of the other ``k - 1``
+  random folds;
+* ``transform_update(batch)`` encodes a batch with the tables built from
+  the batches before it and then adds it, for streaming over ``train.gz``.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from ctr.hashing import FeatureHasher, hash_values
+
+COLUMNS = ('device_ip', 'device_id', 'site_id', 'app_id')
+_PARTS = ('keys', 'count', 'clicks')
+
+
+def encoded_in(features):
+    """The count and CTR features among a model's ``features``."""
+    return [name for name in features if name.endswith(('_count', '_ctr'))]
+
+
+def _hash_codes(values, seed):
+    """``(codes, keys)``: sorted unique hashes of ``values`` and each row's index into them."""
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    keys, remap = np.unique(hash_values(uniques, seed), return_inverse=True)
+    return remap[codes], keys
+
+
+def _ordered_counts(codes, hours, weights):
+    """Sum of ``weights`` over earlier-hour rows with the same code, per row."""
+    hour_rank = np.unique(hours, return_inverse=True)[1].astype(np.int64)
+    n_hours = int(hour_rank.max()) + 1 if len(hour_rank) else 1
+    groups, inverse = np.unique(codes * n_hours + hour_rank, return_inverse=True)
+    sums = np.bincount(inverse, weights=weights)
+    before = np.cumsum(sums) - sums
+    # restart the running total at the first hour of every code
+    code = groups // n_hours
+    first = np.r_[True, code[1:] != code[:-1]]
+    start = np.maximum.accumulate(np.where(first, np.arange(len(groups)), 0))
+    return (before - before[start])[inverse]
+
+
+class TargetEncoder(object):
+    """Impression counts and smoothed CTR of ``columns``, as lookup tables."""
+
+    def __init__(self, columns=COLUMNS, prior_weight=20.0, seed=0, hasher=None):
+        self.columns = list(columns)
+        self.prior_weight = float(prior_weight)
+        self.hasher = hasher or FeatureHasher(seed=seed)
+        self.tables = dict((name, (np.empty(0, np.uint64), np.empty(0, np.uint32),
+                                   np.empty(0, np.uint32))) for name in self.columns)
+        self.impressions = 0
+        self.clicks = 0
+
+    @property
+    def prior(self):
+        return self.clicks / self.impressions if self.impressions else 0.0
+
+    def output_columns(self):
+        return [name + suffix for name in self.columns
+                for suffix in ('_count', '_ctr')]
+
+    def _features(self, df, name, count, clicks):
+        m = self.prior_weight
+        df[name + '_count'] = count.astype(np.float32)
+        df[name + '_ctr'] = ((clicks + m * self.prior) / (count + m)).astype(np.float32)
+
+    def update(self, df, target='click'):
+        """Add the rows of ``df`` to the tables."""
+        y = np.asarray(df[target].values, dtype=np.float64)
+        self.impressions += len(y)
+        self.clicks += int(y.sum())
+        for name in self.columns:
+            codes, keys = _hash_codes(df[name], self.hasher.field_seed(name))
+            count = np.bincount(codes, minlength=len(keys))
+            clicks = np.bincount(codes, weights=y, minlength=len(keys))
+            old_keys, old_count, old_clicks = self.tables[name]
+            keys, merged = np.unique(np.concatenate([old_keys, keys]),
+                                     return_inverse=True)
+            count = np.bincount(merged, weights=np.concatenate([old_count, count]))
+            clicks = np.bincount(merged, weights=np.concatenate([old_clicks, clicks]))
+            self.tables[name] = (keys, count.astype(np.uint32), clicks.astype(np.uint32))
+        return self
+
+    def lookup(self, name, values):
+        """``(impressions, clicks)`` of ``values`` in the fitted table of ``name``."""
+        keys, count, clicks = self.tables[name]
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        if not len(keys):
+            return np.zeros(len(codes)), np.zeros(len(codes))
+        hashed = hash_values(uniques, self.hasher.field_seed(name))
+        pos = np.minimum(np.searchsorted(keys, hashed), len(keys) - 1)
+        found = keys[pos] == hashed
+        n = np.where(found, count[pos], 0).astype(np.float64)
+        c = np.where(found, clicks[pos], 0).astype(np.float64)
+        return n[codes], c[codes]
+
+    def transform(self, df):
+        """Add the features to ``df`` from the fitted tables (for scoring)."""
+        for name in self.columns:
+            self._features(df, name, *self.lookup(name, df[name]))
+        return df
+
+    def transform_update(self, df, target='click'):
+        """Encode ``df`` with the tables so far, then add it to them."""
+        self.transform(df)
+        return self.update(df, target)
+
+    def fit_transform(self, df, hours=None, folds=None, target='click', seed=0):
+        """Fit the tables on ``df`` and add leak-free features to it.
+
+        Pass the time of every row as ``hours`` to encode each row from the
+        rows of earlier hours, or a number of ``folds`` to encode it from
+        the other folds.
+        """
+        if (hours is None) == (folds is None):
+            raise ValueError('pass exactly one of hours or folds')
+        y = np.asarray(df[target].values, dtype=np.float64)
+        # the prior is that of the whole frame, as for scoring
+        self.impressions, self.clicks = len(y), int(y.sum())
+        if folds is not None:
+            fold = np.random.RandomState(seed).randint(0, folds, len(df))
+        for name in self.columns:
+            codes, keys = _hash_codes(df[name], self.hasher.field_seed(name))
+            if hours is not None:
+                count = _ordered_counts(codes, np.asarray(hours), np.ones(len(y)))
+                clicks = _ordered_counts(codes, np.asarray(hours), y)
+            else:
+                cell = fold * len(keys) + codes
+                size = folds * len(keys)
+                count = (np.bincount(codes, minlength=len(keys))[codes]
+                         - np.bincount(cell, minlength=size)[cell])
+                clicks = (np.bincount(codes, weights=y, minlength=len(keys))[codes]
+                          - np.bincount(cell, weights=y, minlength=size)[cell])
+            self.tables[name] = (
+                keys, np.bincount(codes, minlength=len(keys)).astype(np.uint32),
+                np.bincount(codes, weights=y, minlength=len(keys)).astype(np.uint32))
+            self._features(df, name, count, clicks)
+        return df
+
+    def to_arrays(self):
+        """Tables as ``{'<column>.<part>': array}`` plus a JSON-able dict of the rest."""
+        arrays = dict(('%s.%s' % (name, part), values)
+                      for name, table in self.tables.items()
+                      for part, values in zip(_PARTS, table))
+        meta = {'columns': self.columns, 'prior_weight': self.prior_weight,
+                'hasher': self.hasher.to_dict(), 'impressions': self.impressions,
+                'clicks': self.clicks}
+        return arrays, meta
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        encoder = cls(meta['columns'], meta['prior_weight'],
+                      hasher=FeatureHasher.from_dict(meta['hasher']))
+        encoder.impressions, encoder.clicks = meta['impressions'], meta['clicks']
+        for name in encoder.columns:
+            encoder.tables[name] = tuple(arrays['%s.%s' % (name, part)]
+                                         for part in _PARTS)
+        return encoder
+
+    def save(self, directory):
+        """Write the tables as ``.npy`` files plus ``meta.json`` into ``directory``."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        arrays, meta = self.to_arrays()
+        for key, values in arrays.items():
+            np.save(os.path.join(directory, key + '.npy'), values)
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Load tables written by ``save``, memory-mapped by default."""
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = dict(('%s.%s' % (name, part),
+                       np.load(os.path.join(directory, '%s.%s.npy' % (name, part)),
+                               mmap_mode=mmap_mode))
+                      for name in meta['columns'] for part in _PARTS)
+        return cls.from_arrays(arrays, meta)
@@ -0,0 +1,213 @@
+"""Model training on the encoded clickstream."""
+
+import functools
+import json
+import os
+
+import numpy as np
+
+from ctr.cache import CACHE_DIR, cache_key
+from ctr.features import encode_frame
+from ctr.ingest import iter_batches
+from ctr.instrument import stage
+from ctr.schema import compact_types, narrow_ints, types_train
+
+# the notebook's LightGBM params and the settings of run_default_test
+LGB_PARAMS = {
+    'boosting_type': 'gbdt',
+    'objective': 'binary',
+    'metric': 'binary_logloss',
+    'num_leaves': 31,
+    'learning_rate': 0.08,
+    'feature_fraction': 0.7,
+    'bagging_fraction': 0.3,
+    'bagging_freq': 5,
+    'verbose': -1,
+}
+XGB_PARAMS = {
+    'objective': 'binary:logistic',
+    'booster': 'gbtree',
+    'eval_metric': 'logloss',
+    'eta': 0.1,
+    'max_depth': 5,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'verbosity': 0,
+}
+
+
+def json_params(value):
+    """``value`` with sets as sorted lists and NumPy types as Python ones.
+
+    Params written in a notebook often hold a set (``{'binary_logloss'}``)
+    or NumPy scalars, which ``json.dump`` rejects; both boosters accept
+    the converted values unchanged.
+    """
+    if isinstance(value, dict):
+        return dict((str(k), json_params(v)) for k, v in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sorted(json_params(v) for v in value)
+    if isinstance(value, (list, tuple)):
+        return [json_params(v) for v in value]
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    return value
+
+
+def encode_batch(df, hasher, crosses=()):
+    """Training transform for one parsed batch of ``train.gz``."""
+    return encode_frame(narrow_ints(df), hasher, drop=('hour', 'id'), crosses=crosses)
+
+
+def write_matrix(batches, path, label='click'):
+    """Append encoded batches to on-disk float32 feature and label files.
+
+    Writes ``path.X`` (rows x features, C order), ``path.y`` and, once both
+    are complete, ``path.json`` with the shape and feature names.  Only one
+    batch is held in memory at a time.
+    """
+    names = None
+    rows = 0
+    with open(path + '.X', 'wb') as fx, open(path + '.y', 'wb') as fy:
+        for df in batches:
+            if names is None:
+                names = [c for c in df.columns if c != label]
+            fx.write(np.ascontiguousarray(df[names].values, dtype=np.float32).tobytes())
+            fy.write(np.asarray(df[label].values, dtype=np.float32).tobytes())
+            rows += len(df)
+    with open(path + '.json', 'w') as f:
+        json.dump({'rows': rows, 'features': names}, f)
+    return open_matrix(path)
+
+
+def open_matrix(path):
+    """Memory-map a matrix written by ``write_matrix`` as ``(X, y, features)``."""
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    shape = (meta['rows'], len(meta['features']))
+    X = np.memmap(path + '.X', dtype=np.float32, mode='r', shape=shape)
+    y = np.memmap(path + '.y', dtype=np.float32, mode='r', shape=shape[:1])
+    return X, y, meta['features']
+
+
+class MatrixSequence(object):
+    """Lets LightGBM read a memory-mapped matrix in row batches.
+
+    Registered as a virtual ``lgb.Sequence`` on first use, so importing
+    this module does not import LightGBM.
+    """
+
+    def __init__(self, X, batch_size=65536):
+        self.X = X
+        self.batch_size = batch_size
+
+    def __getitem__(self, idx):
+        if isinstance(idx, list):
+            idx = np.asarray(idx)
+        # LightGBM bins from float64; only one batch is converted at a time
+        return np.asarray(self.X[idx], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.X)
+
+
+def build_binary_dataset(src, hasher, params=None, reference=None,
+                         cache_dir=CACHE_DIR, batch_size=100000, workers=None,
+                         crosses=()):
+    """LightGBM ``Dataset`` for all of ``src``, built out of core and cached.
+
+    On the first call ``src`` is streamed through ``iter_batches``, encoded
+    with ``hasher`` (adding the feature ``crosses``) and appended to a
+    memory-mapped float32 matrix, from
+    which LightGBM bins the features batch by batch; the result is saved
+    with ``save_binary`` and the float32 matrix is deleted.  Later calls
+    with the same file, hasher, ``params`` and ``reference`` load the
+    binary file directly and skip parsing and binning.  A validation set
+    must pass the training ``Dataset`` returned by this function as
+    ``reference``.
+    """
+    import lightgbm as lgb
+
+    lgb.Sequence.register(MatrixSequence)
+    cache_dir = os.path.join(cache_dir, 'lightgbm')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    prefix = '%s-%s-' % (os.path.basename(src),
+                         'train' if reference is None else 'valid')
+    crosses = [list(c) for c in crosses]
+    # a validation set is binned with the reference's bin mappers, so a
+    # cached one is only valid for the same training set
+    reference_key = None
+    if reference is not None:
+        reference_key = getattr(reference, 'cache_key', None)
+        if reference_key is None:
+            raise ValueError('reference must be a Dataset returned by build_binary_dataset')
+    key = cache_key(src, hasher=hasher.to_dict(), params=params, crosses=crosses,
+                    reference=reference_key)
+    base = os.path.join(cache_dir, prefix + key)
+    binary = base + '.bin'
+    if not os.path.exists(binary):
+        if not os.path.exists(base + '.json'):
+            batches = iter_batches(src, dtype=compact_types(types_train),
+                                   batch_size=batch_size, workers=workers,
+                                   transform=functools.partial(encode_batch, hasher=hasher,
+                                                             crosses=crosses))
+            write_matrix(batches, base)
+        X, y, features = open_matrix(base)
+        dataset = lgb.Dataset(MatrixSequence(X), label=np.asarray(y),
+                              feature_name=features, params=params,
+                              reference=reference)
+        dataset.save_binary(base + '.tmp.bin')
+        os.replace(base + '.tmp.bin', binary)
+        del dataset, X, y
+        # the binary file holds everything; the float32 matrix is dead weight
+        for ext in ('.X', '.y', '.json'):
+            os.remove(base + ext)
+        for stale in os.listdir(cache_dir):
+            if stale.startswith(prefix) and not stale.startswith(prefix + key):
+                os.remove(os.path.join(cache_dir, stale))
+    dataset = lgb.Dataset(binary, params=params, reference=reference)
+    dataset.cache_key = key
+    return dataset
+
+
+def train_lightgbm(params, train_set, valid_set=None, num_boost_round=4000,
+                   early_stopping_rounds=500):
+    """``lgb.train`` with early stopping on ``valid_set`` when one is given."""
+    import lightgbm as lgb
+
+    callbacks = []
+    valid_sets = None
+    if valid_set is not None:
+        valid_sets = [valid_set]
+        callbacks.append(lgb.early_stopping(early_stopping_rounds))
+    with stage('train') as record:
+        booster = lgb.train(params, train_set, num_boost_round=num_boost_round,
+                            valid_sets=valid_sets, callbacks=callbacks)
+        record['rows'] = train_set.num_data()
+    return booster
+
+
+def run_default_test(fm, split, features, label, random_state=0, params=None):
+    """Train XGBoost with ``XGB_PARAMS`` on the ``features`` columns of ``fm``.
+
+    ``split`` is the ``(train_rows, valid_rows)`` pair from ``time_split``;
+    ``params`` override the defaults.  Stops early on the validation
+    logloss and returns the booster.
+    """
+    import xgboost as xgb
+
+    params = dict(XGB_PARAMS, seed=random_state, **(params or {}))
+    print('XGBoost params. ETA: {}, MAX_DEPTH: {}, SUBSAMPLE: {}, COLSAMPLE_BY_TREE: {}'.format(
+        params['eta'], params['max_depth'], params['subsample'], params['colsample_bytree']))
+    num_boost_round = 260
+    early_stopping_rounds = 20
+
+    train_rows, valid_rows = split
+    dtrain, dvalid = fm.columns(features).xgb_dmatrices(label, train_rows, valid_rows)
+    watchlist = [(dtrain, 'train'), (dvalid, 'eval')]
+    with stage('xgb_train') as record:
+        gbm = xgb.train(params, dtrain, num_boost_round, evals=watchlist,
+                        early_stopping_rounds=early_stopping_rounds, verbose_eval=True)
+    print('Trained in {seconds:.0f}s ({cpu_seconds:.0f}s CPU), peak RSS {peak_rss_mb:.0f} MB'.format(**record))
+    return gbm
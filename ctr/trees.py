@@ -0,0 +1,254 @@
+"""Flattened tree ensembles for fast batch inference.
+
+A trained LightGBM or XGBoost booster is exported into a handful of
+contiguous NumPy arrays (split feature, threshold, children, missing-value
+handling and leaf value per node).  ``TreeEnsemble.predict`` walks all trees
+for a batch of rows at once, one tree level per step over every pending
+(row, tree) pair, and uses a compiled Numba kernel instead when Numba is
+installed.  Outputs match the booster's own
+``predict`` to floating point tolerance.
+"""
+
+import json
+
+import numpy as np
+
+# how a split treats missing values; MISSING_NONE maps NaN to 0.0 first
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+_LGB_MISSING = {'None': MISSING_NONE, 'Zero': MISSING_ZERO, 'NaN': MISSING_NAN}
+_ZERO_THRESHOLD = 1e-35
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+_ARRAYS = ('feature', 'threshold', 'left', 'right', 'default_left',
+           'missing_type', 'value', 'roots')
+
+
+class _Builder(object):
+    def __init__(self):
+        self.nodes = []
+        self.roots = []
+
+    def add(self, feature=-1, threshold=0.0, default_left=False,
+            missing_type=MISSING_NONE, value=0.0):
+        self.nodes.append([feature, threshold, -1, -1, default_left,
+                           missing_type, value])
+        return len(self.nodes) - 1
+
+    def arrays(self):
+        nodes = self.nodes
+        left = np.array([n[2] for n in nodes], dtype=np.int32)
+        right = np.array([n[3] for n in nodes], dtype=np.int32)
+        # leaves point at themselves so extra levels leave them in place
+        leaf = left < 0
+        left[leaf] = right[leaf] = np.flatnonzero(leaf)
+        return {'feature': np.array([n[0] for n in nodes], dtype=np.int32),
+                'threshold': np.array([n[1] for n in nodes], dtype=np.float64),
+                'left': left,
+                'right': right,
+                'default_left': np.array([n[4] for n in nodes], dtype=bool),
+                'missing_type': np.array([n[5] for n in nodes], dtype=np.int8),
+                'value': np.array([n[6] for n in nodes], dtype=np.float64),
+                'roots': np.array(self.roots, dtype=np.int32)}
+
+
+class TreeEnsemble(object):
+    """An additive tree ensemble stored as flat node arrays."""
+
+    def __init__(self, arrays, feature_names, base_score=0.0, sigmoid=1.0,
+                 float32_input=False):
+        for name in _ARRAYS:
+            setattr(self, name, np.ascontiguousarray(arrays[name]))
+        self.feature_names = list(feature_names)
+        self.base_score = float(base_score)
+        self.sigmoid = sigmoid
+        self.float32_input = float32_input
+
+    @classmethod
+    def from_lightgbm(cls, booster, num_iteration=None):
+        """Export a ``lightgbm.Booster`` with a binary or regression objective."""
+        if num_iteration is None and booster.best_iteration > 0:
+            num_iteration = booster.best_iteration
+        model = booster.dump_model(num_iteration=num_iteration)
+        objective = model.get('objective', '')
+        sigmoid = None
+        if objective.startswith('binary'):
+            sigmoid = 1.0
+            for token in objective.split():
+                if token.startswith('sigmoid:'):
+                    sigmoid = float(token.split(':')[1])
+        elif model.get('num_tree_per_iteration', 1) != 1:
+            raise NotImplementedError('multiclass models are not supported')
+
+        builder = _Builder()
+
+        def visit(node):
+            if 'leaf_value' in node:
+                return builder.add(value=node['leaf_value'])
+            if node['decision_type'] != '<=':
+                raise NotImplementedError('categorical splits are not supported')
+            i = builder.add(feature=node['split_feature'],
+                            threshold=node['threshold'],
+                            default_left=node['default_left'],
+                            missing_type=_LGB_MISSING[node['missing_type']])
+            builder.nodes[i][2] = visit(node['left_child'])
+            builder.nodes[i][3] = visit(node['right_child'])
+            return i
+
+        for tree in model['tree_info']:
+            builder.roots.append(visit(tree['tree_structure']))
+        return cls(builder.arrays(), model['feature_names'], sigmoid=sigmoid)
+
+    @classmethod
+    def from_xgboost(cls, booster):
+        """Export an ``xgboost.Booster`` with a ``binary:logistic`` or regression objective."""
+        config = json.loads(booster.save_config())
+        learner = config['learner']
+        objective = learner['objective']['name']
+        base_score = float(learner['learner_model_param']['base_score'].strip('[]'))
+        sigmoid = None
+        if objective == 'binary:logistic':
+            sigmoid = 1.0
+            base_score = np.log(base_score / (1 - base_score))
+        elif objective not in ('reg:squarederror', 'binary:logitraw'):
+            raise NotImplementedError('objective %s is not supported' % objective)
+        names = booster.feature_names
+        if names is None:
+            names = ['f%d' % i for i in range(booster.num_features())]
+        index = dict((name, i) for i, name in enumerate(names))
+
+        builder = _Builder()
+
+        def visit(node):
+            if 'leaf' in node:
+                return builder.add(value=node['leaf'])
+            # xgboost sends x < t left; x <= the float32 below t is the same test
+            threshold = np.nextafter(np.float32(node['split_condition']), np.float32(-np.inf))
+            i = builder.add(feature=index[node['split']], threshold=float(threshold),
+                            default_left=node['missing'] == node['yes'],
+                            missing_type=MISSING_NAN)
+            children = dict((child['nodeid'], child) for child in node['children'])
+            builder.nodes[i][2] = visit(children[node['yes']])
+            builder.nodes[i][3] = visit(children[node['no']])
+            return i
+
+        for dump in booster.get_dump(dump_format='json'):
+            builder.roots.append(visit(json.loads(dump)))
+        return cls(builder.arrays(), names, base_score=base_score,
+                   sigmoid=sigmoid, float32_input=True)
+
+    def _matrix(self, X):
+        if hasattr(X, 'columns'):
+            X = X[self.feature_names].values
+        X = np.asarray(X)
+        if self.float32_input:
+            X = X.astype(np.float32)
+        return np.ascontiguousarray(X, dtype=np.float64)
+
+    def _raw_numpy(self, X, out):
+        n_trees = len(self.roots)
+        check_missing = (np.isnan(X).any()
+                         or (self.missing_type == MISSING_ZERO).any())
+        # bound the (row, tree) work lists to a few million entries
+        step = max(1, 4000000 // max(n_trees, 1))
+        for start in range(0, len(X), step):
+            x = X[start:start + step]
+            total = np.zeros(len(x))
+            rows = np.repeat(np.arange(len(x)), n_trees)
+            nodes = np.tile(self.roots, len(x))
+            while len(nodes):
+                feature = self.feature[nodes]
+                leaf = feature < 0
+                if leaf.any():
+                    total += np.bincount(rows[leaf], weights=self.value[nodes[leaf]],
+                                         minlength=len(x))
+                    keep = ~leaf
+                    rows, nodes, feature = rows[keep], nodes[keep], feature[keep]
+                values = x[rows, feature]
+                if check_missing:
+                    missing_type = self.missing_type[nodes]
+                    isnan = np.isnan(values)
+                    values[isnan & (missing_type == MISSING_NONE)] = 0.0
+                    missing = ((isnan & (missing_type != MISSING_NONE))
+                               | ((missing_type == MISSING_ZERO)
+                                  & (np.abs(values) <= _ZERO_THRESHOLD)))
+                    go_left = np.where(missing, self.default_left[nodes],
+                                       values <= self.threshold[nodes])
+                else:
+                    go_left = values <= self.threshold[nodes]
+                nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+            out[start:start + step] = total
+        return out
+
+    def predict_raw(self, X):
+        """Sum of leaf values plus the base score (the margin) for each row."""
+        X = self._matrix(X)
+        out = np.empty(len(X), dtype=np.float64)
+        if numba is not None:
+            _walk(X, self.feature, self.threshold, self.left, self.right,
+                  self.default_left, self.missing_type, self.value, self.roots, out)
+        else:
+            self._raw_numpy(X, out)
+        return out + self.base_score
+
+    def predict(self, X):
+        """Predicted probabilities for binary models, raw scores otherwise."""
+        raw = self.predict_raw(X)
+        if self.sigmoid is None:
+            return raw
+        return 1.0 / (1.0 + np.exp(-self.sigmoid * raw))
+
+    def to_arrays(self):
+        """Node arrays plus a JSON-able dict of the remaining attributes."""
+        meta = {'feature_names': self.feature_names, 'base_score': self.base_score, 'sigmoid': self.sigmoid,
+                'float32_input': self.float32_input}
+        return dict((name, getattr(self, name)) for name in _ARRAYS), meta
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        return cls(arrays, **meta)
+
+    def save(self, path):
+        """Write the ensemble to an ``.npz`` file readable without LightGBM."""
+        arrays, meta = self.to_arrays()
+        np.savez(path, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            arrays = dict((name, f[name]) for name in _ARRAYS)
+            meta = json.loads(str(f['meta']))
+        return cls.from_arrays(arrays, meta)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _walk(X, feature, threshold, left, right, default_left, missing_type,
+              value, roots, out):
+        # blocks of rows run in parallel; within a block every tree is
+        # walked for all rows before moving on, so its nodes stay in cache
+        n = X.shape[0]
+        block = 64
+        for b in numba.prange((n + block - 1) // block):
+            lo = b * block
+            hi = min(lo + block, n)
+            for i in range(lo, hi):
+                out[i] = 0.0
+            for t in range(roots.shape[0]):
+                for i in range(lo, hi):
+                    node = roots[t]
+                    while feature[node] >= 0:
+                        x = X[i, feature[node]]
+                        kind = missing_type[node]
+                        if np.isnan(x) and kind == MISSING_NONE:
+                            x = 0.0
+                        if (np.isnan(x) or (kind == MISSING_ZERO
+                                            and abs(x) <= _ZERO_THRESHOLD)):
+                            go_left = default_left[node]
+                        else:
+                            go_left = x <= threshold[node]
+                        node = left[node] if go_left else right[node]
+                    out[i] += value[node]